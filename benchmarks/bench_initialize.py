@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""\
+Time Epub.initialize() on synthetic books with growing spine/TOC size.
+
+Usage:
+    python benchmarks/bench_initialize.py [N ...]
+
+Opening time per spine item should stay roughly flat as N grows.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import epr  # noqa: E402
+from synth import make_epub  # noqa: E402
+
+
+def main():
+    sizes = [int(i) for i in sys.argv[1:]] or [500, 1000, 2000, 4000, 8000]
+    with tempfile.TemporaryDirectory() as tmp:
+        print("{:>8} {:>10} {:>12}".format("items", "seconds", "us/item"))
+        for n in sizes:
+            path = os.path.join(tmp, "book{}.epub".format(n))
+            make_epub(path, chapters=n, paragraphs=0)
+            ebook = epr.Epub(path)
+            start = time.perf_counter()
+            ebook.initialize()
+            elapsed = time.perf_counter() - start
+            assert len(ebook.contents) == n and ebook.toc_entries[-1] == "Chapter {}".format(n)
+            print("{:>8} {:>10.4f} {:>12.2f}".format(n, elapsed, elapsed / n * 1e6))
+
+
+if __name__ == "__main__":
+    main()
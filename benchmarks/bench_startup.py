@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""\
+Time common epr entry points from process start to exit.
+
+Usage:
+    python benchmarks/bench_startup.py [RUNS]
+
+Each entry point runs RUNS times (default 10) in a fresh interpreter with
+an empty HOME, median and min wall time are reported.
+"""
+
+import os
+import py_compile
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EPR = os.path.join(HERE, "..", "epr.py")
+sys.path.insert(0, HERE)
+from synth import make_epub  # noqa: E402
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    # time startup, not compiling epr.py
+    py_compile.compile(EPR)
+    with tempfile.TemporaryDirectory() as tmp:
+        book = os.path.join(tmp, "book.epub")
+        make_epub(book, chapters=20, paragraphs=20)
+        env = dict(os.environ, HOME=tmp, XDG_CACHE_HOME=os.path.join(tmp, "cache"))
+        entries = [
+            ("import", ["-c", "import sys; sys.path.insert(0, {!r}); import epr".format(os.path.dirname(EPR))]),
+            ("-v", [EPR, "-v"]),
+            ("-h", [EPR, "-h"]),
+            ("-r", [EPR, "-r"]),
+            ("open", ["-c", "import sys; sys.path.insert(0, {!r}); import epr; "
+                            "e = epr.Epub({!r}); e.initialize(); e.get_meta()".format(os.path.dirname(EPR), book)]),
+            ("-d", [EPR, "-d", "--jobs=1", book]),
+        ]
+        print("{:<8} {:>10} {:>10}".format("entry", "median ms", "min ms"))
+        for name, args in entries:
+            times = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                subprocess.run(
+                    [sys.executable] + args, env=env,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+                )
+                times.append((time.perf_counter() - start) * 1000)
+            print("{:<8} {:>10.1f} {:>10.1f}".format(name, statistics.median(times), min(times)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""\
+Check that anchored search patterns match like a line-by-line search.
+
+Usage:
+    python benchmarks/check_search.py [EPUB...]
+
+The reader matches a pattern against a chapter's paragraphs joined by
+newlines. For every book of the synthetic corpus (see run.py) and the
+given EPUBs, patterns using ^ and $ must give the same number of matches
+through iter_search() as a finditer() over each line of the unwrapped text
+on its own, which is how epr searched before. Exits with 1 on any
+difference.
+"""
+
+import os
+import re
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+import epr  # noqa: E402
+from run import CORPUS  # noqa: E402
+from synth import make_epub  # noqa: E402
+
+PATTERNS = [r"^dolor", r"\.$", r"^lorem ipsum", r"aliqua\.$", r"^ +\w", r"^$", r"^\w+ \w+$"]
+
+
+def line_by_line(path, pattern):
+    n = 0
+    for _, para in epr.iter_lines(path, 0):
+        for line in para.split("\n"):
+            n += sum(1 for _ in pattern.finditer(line))
+    return n
+
+
+def main():
+    diff = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        books = []
+        for name, kw in CORPUS.items():
+            path = os.path.join(tmp, name + ".epub")
+            make_epub(path, **kw)
+            books.append(path)
+        books += sys.argv[1:]
+
+        for path in books:
+            for i in PATTERNS:
+                want = line_by_line(path, re.compile(i, re.IGNORECASE))
+                got = sum(1 for _ in epr.iter_search(path, i, width=0))
+                if got != want:
+                    diff += 1
+                print("{:4} {:30} {:14} {:6} {:6}".format(
+                    "ok" if got == want else "DIFF", os.path.basename(path)[:30], i, want, got
+                ))
+    return 1 if diff else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""\
+Check epr's worker processes under the spawn start method.
+
+Usage:
+    python benchmarks/check_spawn.py
+
+Windows (and the frozen Windows binary) can only spawn workers: each one
+starts a fresh interpreter that imports epr and unpickles its task, so
+nothing set up in the parent is inherited. Every check runs its worker
+processes that way on a synthetic book and compares the result with the
+same work done in this process. Exits with 1 on any difference.
+"""
+
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+import epr  # noqa: E402
+from synth import make_epub  # noqa: E402
+
+
+def check_search(path):
+    # BookSearch hits per chapter against the in-process iter_search()
+    ebook = epr.Epub(path)
+    ebook.initialize()
+    pattern = re.compile("dolor[a-z ]+magna", re.IGNORECASE)
+    book = epr.BookSearch(ebook, pattern, len(ebook.contents) // 2)
+    end = time.time() + 60
+    while not book.done and time.time() < end:
+        book.poll()
+        time.sleep(0.01)
+    got = [len(i) // 2 for i in book.spans]
+    want = [0] * len(ebook.contents)
+    for n, _ in epr.iter_search(path, pattern):
+        want[n] += 1
+    return book.done and got == want
+
+
+def check_dump(path):
+    # -d --jobs=3 --outdir against a serial dump
+    out = {}
+    for jobs in (1, 3):
+        outdir = os.path.join(os.path.dirname(path), "dump{}".format(jobs))
+        epr.dump_epub(path, 60, outdir, jobs)
+        out[jobs] = {i: open(os.path.join(outdir, i), "rb").read() for i in os.listdir(outdir)}
+    return out[1] == out[3] and len(out[3]) > 1
+
+
+def check_index(path):
+    # --index --warm --jobs=2 rows against index_worker() in this process
+    epr.index_library(os.path.dirname(path), True, 2)
+    got = epr.STATEDB.execute("SELECT * FROM library").fetchall()
+    return got == [epr.index_worker(path, False)[0]]
+
+
+def check_prefetch(path):
+    # --prefetch=process: adjacent chapters and the book's line counts
+    # against the same chapters wrapped in this process
+    ebook = epr.Epub(path)
+    ebook.initialize()
+    prefetcher = epr.Prefetcher("process")
+    try:
+        prefetcher.schedule(ebook, 3, 60)
+        index = epr.LineIndex(ebook, 60)
+        prefetcher.count(index)
+        for i in (2, 4):
+            prefetcher.take((path, i, 60))
+        end = time.time() + 60
+        while index.missing() is not None and time.time() < end:
+            time.sleep(0.01)
+    finally:
+        prefetcher.shutdown()
+    ok = True
+    for n in range(len(ebook.contents)):
+        lines = epr.wrap_chapter(epr.parse_chapter(ebook, ebook.contents[n]), 60)[0]
+        ok = ok and index.counts[n] == len(lines)
+        if n in (2, 4):
+            ok = ok and list(epr.CHAPTERCACHE.get((path, n, 60))[0]) == list(lines)
+    return ok
+
+
+CHECKS = {
+    "search": check_search,
+    "dump": check_dump,
+    "index": check_index,
+    "prefetch": check_prefetch,
+}
+
+
+def main():
+    multiprocessing.set_start_method("spawn")
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        # reading state and catalog go to a throwaway home
+        os.environ["HOME"] = tmp
+        epr.loadstate()
+        epr.prefetch_init(os.path.join(tmp, "cache"), True)
+        path = os.path.join(tmp, "book.epub")
+        make_epub(path, chapters=12, paragraphs=40)
+        for name, check in CHECKS.items():
+            t = time.perf_counter()
+            ok = check(path)
+            failed += not ok
+            print("{:8} {} {:.2f}s".format(name, "ok" if ok else "FAILED", time.perf_counter() - t))
+        # an open database can't be removed on Windows
+        epr.STATEDB.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
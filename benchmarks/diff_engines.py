@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""\
+Check that the expat and HTMLParser converter engines agree.
+
+Usage:
+    python benchmarks/diff_engines.py [EPUB...]
+
+Every chapter of the synthetic corpus (see run.py), a set of hand-written
+edge cases and the given EPUBs goes through both xhtml_to_lines() and
+html_to_lines(). Their text, imgs and index sets must be identical unless
+the expat engine declined the input (counted as fallback). Prints the time
+spent in each engine and exits with 1 on any difference.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+import epr  # noqa: E402
+from run import CORPUS  # noqa: E402
+from synth import make_epub  # noqa: E402
+
+HEAD = '<?xml version="1.0" encoding="utf-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml"><head><title>t</title></head>'
+
+CASES = {
+    "self-closing": HEAD + '<body><p>a<br/>b<br />c</p><p/><div/><img src="a.png"/>'
+                    '<img src="b%20c.png"></img><p>d</p></body></html>',
+    "svg-image": HEAD + '<body><svg xmlns:xlink="http://www.w3.org/1999/xlink">'
+                 '<image width="1" xlink:href="cover.jpg"/></svg><p>x</p></body></html>',
+    "entities": HEAD + '<body><p>a&nbsp;b &amp;amp; &lt;c&gt; &mdash; &#8217; &#x2014; &foo; &amp;nbsp;</p>'
+                '<p title="&amp;">x &hellip;</p></body></html>',
+    "pre": HEAD + '<body><pre>  a\n\tb  &lt;x&gt;\n\n  c</pre><p>  d\n  e  </p></body></html>',
+    "markup": HEAD + '<body><!-- c --><p>a<!-- c -->b<?pi x?>c<![CDATA[hidden]]>d</p>'
+              '<h2 id="x">T<sup>2</sup> H<sub>2</sub></h2><ul><li>i</li><li><p>j</p></li></ul>'
+              '<blockquote>q</blockquote><dl><dt>t</dt><dd>d</dd></dl></body></html>',
+    "uppercase": HEAD + '<BODY><P>a</P><H1>b</H1><IMG SRC="c.png"/></BODY></html>',
+    "hidden": HEAD + '<body><script>var a = 1;</script><style>p {}</style><p>a</p></body></html>',
+    "trailing-text": '<html><body>a</body></html>\n\n',
+    "bom": '﻿' + HEAD + '\n<body><p>a</p></body></html>\n',
+    "bom-doctype": '﻿<?xml version="1.0"?>\n<!DOCTYPE html>\n<html><body>b</body></html>',
+    "no-decl": '<html><body><p>a</p>tail</body></html>',
+    "malformed": HEAD + '<body><p>a<br>b</p></body></html>',
+    "html-void": HEAD + '<body><p>a<img src="x.png">b</p></body></html>',
+    "c1-charref": HEAD + '<body><p>a&#150;b</p></body></html>',
+    "crlf-pre": HEAD + '<body><pre>a\r\nb</pre></body></html>',
+}
+
+
+def chapters(path):
+    with zipfile.ZipFile(path) as z:
+        for i in z.namelist():
+            if i.endswith((".html", ".xhtml", ".htm")):
+                yield "{}:{}".format(os.path.basename(path), i), z.read(i)
+
+
+def main():
+    diff = fallback = total = 0
+    times = [0.0, 0.0]
+    with tempfile.TemporaryDirectory() as tmp:
+        sources = [("case:" + i, j.encode("utf-8")) for i, j in CASES.items()]
+        for name, kw in CORPUS.items():
+            path = os.path.join(tmp, name + ".epub")
+            make_epub(path, **kw)
+            sources += list(chapters(path))
+        for path in sys.argv[1:]:
+            sources += list(chapters(path))
+
+        for name, content in sources:
+            total += 1
+            t = time.perf_counter()
+            a = epr.xhtml_to_lines(content)
+            times[0] += time.perf_counter() - t
+            t = time.perf_counter()
+            b = epr.html_to_lines(content)
+            times[1] += time.perf_counter() - t
+            if a is None:
+                fallback += 1
+                print("fallback", name)
+            elif epr.parser_data(a) != epr.parser_data(b):
+                diff += 1
+                print("DIFF", name)
+                for i, (x, y) in enumerate(zip(epr.parser_data(a), epr.parser_data(b))):
+                    if x != y:
+                        print("  field {}:\n    xml  {!r}\n    html {!r}".format(i, x, y))
+                        break
+
+    print("{} chapters, {} differ, {} fell back".format(total, diff, fallback))
+    print("expat {:.3f}s, HTMLParser {:.3f}s".format(*times))
+    return 1 if diff else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
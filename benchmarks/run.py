@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""\
+Benchmark epr hot paths on a synthetic EPUB corpus.
+
+Usage:
+    python benchmarks/run.py                  run and compare with baseline
+    python benchmarks/run.py --save           run and store as baseline
+    python benchmarks/run.py -k huge          only books matching "huge"
+    python benchmarks/run.py --repeat 5       best of 5 runs (default 3)
+    python benchmarks/run.py --tolerance 1.3  fail above 1.3x baseline
+
+Stages: open (Epub.__init__), initialize, feed (parse_chapter),
+get_lines (wrap at 80 cols), search (regex over every chapter) and dump (-d).
+Time is best of --repeat runs, memory is tracemalloc peak of a separate run.
+Exits with 1 if any stage got slower than tolerance x baseline.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import epr  # noqa: E402
+from synth import make_epub  # noqa: E402
+
+BASELINE = os.path.join(HERE, "baseline.json")
+
+# name: make_epub() keywords
+CORPUS = {
+    "epub2-many-tiny": dict(version="2.0", chapters=400, paragraphs=3),
+    "epub3-many-tiny": dict(version="3.0", chapters=400, paragraphs=3),
+    "epub2-huge-chapter": dict(version="2.0", chapters=1, paragraphs=20000),
+    "epub3-deep-nesting": dict(version="3.0", chapters=10, paragraphs=300, depth=30),
+    "epub2-heavy-pre": dict(version="2.0", chapters=10, paragraphs=300, pre=0.7),
+    "epub3-big-toc": dict(version="3.0", chapters=50, paragraphs=40, toc_entries=100),
+}
+
+
+def stage_open(path, state):
+    state["epub"] = epr.Epub(path)
+
+
+def stage_initialize(path, state):
+    ebook = epr.Epub(path)
+    ebook.initialize()
+    state["epub"] = ebook
+
+
+def stage_feed(path, state):
+    ebook = state["epub"]
+    state["parsers"] = [epr.parse_chapter(ebook, i) for i in ebook.contents]
+
+
+def stage_get_lines(path, state):
+    state["wrapped"] = [epr.wrap_chapter(i, 80) for i in state["parsers"]]
+
+
+def stage_search(path, state):
+    pattern = re.compile("dolor[a-z ]+magna", re.IGNORECASE)
+    hits = 0
+    for parser, (lines, imgs, starts) in zip(state["parsers"], state["wrapped"]):
+        hits += len(epr.search_chapter(parser, lines, starts, pattern))
+    state["hits"] = hits
+
+
+def stage_dump(path, state):
+    stdout = sys.stdout
+    with open(os.devnull, "w") as sys.stdout:
+        try:
+            epr.dump_epub(path, jobs=1)
+        finally:
+            sys.stdout = stdout
+
+
+STAGES = [
+    ("open", stage_open),
+    ("initialize", stage_initialize),
+    ("feed", stage_feed),
+    ("get_lines", stage_get_lines),
+    ("search", stage_search),
+    ("dump", stage_dump),
+]
+
+
+def run_book(path, repeat):
+    result = {}
+    for name, _ in STAGES:
+        result[name] = {"seconds": float("inf"), "peak_kib": 0}
+    for _ in range(repeat):
+        state = {}
+        for name, func in STAGES:
+            start = time.perf_counter()
+            func(path, state)
+            result[name]["seconds"] = min(result[name]["seconds"], time.perf_counter() - start)
+    state = {}
+    for name, func in STAGES:
+        tracemalloc.start()
+        func(path, state)
+        result[name]["peak_kib"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser(description="epr benchmarks")
+    ap.add_argument("-k", default="", help="only run books whose name contains this")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--save", action="store_true", help="store results as baseline")
+    ap.add_argument("--baseline", default=BASELINE)
+    ap.add_argument("--tolerance", type=float, default=1.25)
+    opts = ap.parse_args()
+
+    # measure parsing, not the on-disk chapter cache
+    epr.DISKCACHE = False
+
+    baseline = {}
+    if os.path.exists(opts.baseline):
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+
+    results, regressions = {}, []
+    with tempfile.TemporaryDirectory() as tmp:
+        for book, kwargs in CORPUS.items():
+            if opts.k not in book:
+                continue
+            path = os.path.join(tmp, book + ".epub")
+            make_epub(path, **kwargs)
+            results[book] = run_book(path, opts.repeat)
+            print(book)
+            for stage, res in results[book].items():
+                base = baseline.get(book, {}).get(stage)
+                line = "  {:<12} {:>9.4f}s {:>9} KiB".format(stage, res["seconds"], res["peak_kib"])
+                if base is not None:
+                    ratio = res["seconds"] / max(base["seconds"], 1e-9)
+                    line += "  {:>5.2f}x".format(ratio)
+                    # ignore noise on stages that take next to no time
+                    if ratio > opts.tolerance and res["seconds"] - base["seconds"] > 0.01:
+                        line += "  REGRESSION"
+                        regressions.append((book, stage))
+                print(line)
+
+    if opts.save:
+        baseline.update(results)
+        with open(opts.baseline, "w") as f:
+            json.dump(baseline, f, indent=4)
+        print("Saved baseline to", opts.baseline)
+    elif regressions:
+        sys.exit("{} stage(s) regressed".format(len(regressions)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""\
+Synthetic EPUB generator for benchmarks.
+
+    make_epub(path, version="2.0", chapters=10, paragraphs=50, ...)
+
+Produces a valid EPUB2 (NCX) or EPUB3 (nav document) with tunable chapter
+count and size, nesting depth, share of <pre> blocks and extra TOC entries.
+"""
+
+import random
+import zipfile
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua ut enim ad minim "
+    "veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea "
+    "commodo consequat duis aute irure in reprehenderit voluptate velit esse"
+).split()
+
+CONTAINER = (
+    '<?xml version="1.0"?>'
+    '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+    '<rootfiles><rootfile full-path="OEBPS/content.opf"'
+    ' media-type="application/oebps-package+xml"/></rootfiles></container>'
+)
+
+
+def sentence(rnd, n):
+    return " ".join(rnd.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+
+def paragraph(rnd, n, depth, pre):
+    if pre and rnd.random() < pre:
+        code = "\n".join(
+            "    " * rnd.randint(0, 3) + " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 16)))
+            for _ in range(rnd.randint(3, 20))
+        )
+        return "<pre>" + code + "</pre>"
+    text = " ".join(sentence(rnd, rnd.randint(5, 20)) for _ in range(rnd.randint(1, 6)))
+    if rnd.random() < 0.1:
+        text = "<em>" + text[:20] + "</em>" + text[20:] + ' H<sub>2</sub>O &amp; x<sup>2</sup>'
+    html = "<p>" + text + "</p>"
+    for d in range(depth):
+        html = ("<div>", "<blockquote>", "<ul><li>")[d % 3] + html \
+            + ("</div>", "</blockquote>", "</li></ul>")[d % 3]
+    return html
+
+
+def chapter(rnd, n, paragraphs, depth, pre, anchors):
+    body = ['<h1 id="s0">Chapter {}</h1>'.format(n + 1)]
+    every = max(1, paragraphs // max(1, anchors))
+    for i in range(paragraphs):
+        if anchors and i % every == 0 and i // every < anchors:
+            body.append('<h2 id="s{0}">Section {0}</h2>'.format(i // every + 1))
+        body.append(paragraph(rnd, i, depth, pre))
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Chapter {}</title>'
+        '<style>p {{ margin: 0 }}</style></head><body>'.format(n + 1)
+        + "\n".join(body) + "</body></html>"
+    )
+
+
+def make_epub(path, version="2.0", chapters=10, paragraphs=50, depth=0,
+              pre=0.0, toc_entries=0, seed=0):
+    """toc_entries: extra TOC entries per chapter pointing at section anchors"""
+    rnd = random.Random(seed)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("mimetype", "application/epub+zip", zipfile.ZIP_STORED)
+        z.writestr("META-INF/container.xml", CONTAINER)
+
+        manifest = "".join(
+            '<item id="c{0}" href="text/ch{0}.xhtml" media-type="application/xhtml+xml"/>'.format(i)
+            for i in range(chapters)
+        )
+        spine = "".join('<itemref idref="c{}"/>'.format(i) for i in range(chapters))
+        if version == "2.0":
+            tocitem = '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+        else:
+            tocitem = '<item id="nav" href="nav.xhtml" properties="nav" media-type="application/xhtml+xml"/>'
+        z.writestr(
+            "OEBPS/content.opf",
+            '<?xml version="1.0"?>'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="{}">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            '<dc:title>Synthetic</dc:title><dc:creator>Benchmark</dc:creator>'
+            '<dc:language>en</dc:language></metadata>'
+            '<manifest>{}{}</manifest><spine toc="ncx">{}</spine></package>'.format(
+                version, tocitem, manifest, spine
+            )
+        )
+
+        points = []
+        for i in range(chapters):
+            points.append(("text/ch{}.xhtml".format(i), "Chapter {}".format(i + 1)))
+            for j in range(toc_entries):
+                points.append(("text/ch{}.xhtml#s{}".format(i, j + 1), "Section {}.{}".format(i + 1, j + 1)))
+        if version == "2.0":
+            navmap = "".join(
+                '<navPoint id="n{0}" playOrder="{0}"><navLabel><text>{1}</text></navLabel>'
+                '<content src="{2}"/></navPoint>'.format(n, label, src)
+                for n, (src, label) in enumerate(points)
+            )
+            z.writestr(
+                "OEBPS/toc.ncx",
+                '<?xml version="1.0"?><ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+                "<navMap>" + navmap + "</navMap></ncx>"
+            )
+        else:
+            items = "".join('<li><a href="{}">{}</a></li>'.format(src, label) for src, label in points)
+            z.writestr(
+                "OEBPS/nav.xhtml",
+                '<?xml version="1.0" encoding="utf-8"?>'
+                '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+                '<head><title>Nav</title></head><body><nav epub:type="toc"><ol>'
+                + items + "</ol></nav></body></html>"
+            )
+
+        for i in range(chapters):
+            z.writestr(
+                "OEBPS/text/ch{}.xhtml".format(i),
+                chapter(rnd, i, paragraphs, depth, pre, toc_entries)
+            )
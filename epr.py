@@ -10,7 +10,22 @@ Usages:
 Options:
     -r              print reading history
     -d              dump epub
+    --width=N       (with -d) wrap dumped text to N cols
+    --outdir=DIR    (with -d) write each chapter to DIR/N.txt
+    --jobs=N        (with -d or --index) parse with N
+                    processes
     -h, --help      print short, long help
+    --no-cache      don't use on-disk chapter cache
+    --clear-cache   clear on-disk chapter cache
+    --index DIR     catalog every epub under DIR
+    --warm          (with --index) also cache their chapters
+    --prefetch=MODE prefetch adjacent chapters using
+                    MODE: thread (default), process or off
+    --trace=FILE    append per chapter timings and bytes
+                    sent per frame to FILE
+                    (or set EPR_TRACE=FILE)
+    --trace-summary FILE
+                    print per stage percentiles of FILE
 
 Key Binding:
     Help             : ?
@@ -34,9 +49,11 @@ Key Binding:
     Shrink           : -
     Enlarge          : +
     ToC              : TAB       t
+    Filter ToC       : / (in ToC)
     Metadata         : m
     Mark pos to n    : b[n]
     Jump to pos n    : `[n]
+    Jump to n% book  : [n]%
     Switch colorsch  : [default=0, dark=1, light=2]c
 """
 
@@ -48,36 +65,41 @@ __email__ = "benawiadha@gmail.com"
 __url__ = "https://github.com/wustho/epr"
 
 
-import curses
-import zipfile
+# NOTE: only what's needed on every path is imported here, the rest
+# (zipfile, xml.etree, xml.parsers.expat, textwrap, unicodedata, sqlite3,
+# subprocess, tempfile, hashlib, concurrent.futures) is imported where it's
+# used to keep startup fast; curses is only imported by the interactive
+# reader, so the library API (iter_chapters() and co.) works without it
 import sys
 import re
 import os
-import textwrap
+import posixpath
 import json
-import tempfile
 import shutil
-import subprocess
-import xml.etree.ElementTree as ET
+import marshal
+import atexit
+import time
+import threading
 from urllib.parse import unquote
 from html import unescape
 from html.parser import HTMLParser
-from difflib import SequenceMatcher as SM
+from collections import OrderedDict, deque
+from bisect import bisect_right
 
 
-# key bindings
-SCROLL_DOWN = {curses.KEY_DOWN}
+# key bindings, curses.KEY_* ones are added by init_curses()
+SCROLL_DOWN = set()
 SCROLL_DOWN_J = {ord("j")}
-SCROLL_UP = {curses.KEY_UP}
+SCROLL_UP = set()
 SCROLL_UP_K = {ord("k")}
 HALF_DOWN = {4}
 HALF_UP = {21}
-PAGE_DOWN = {curses.KEY_NPAGE, ord("l"), ord(" "), curses.KEY_RIGHT}
-PAGE_UP = {curses.KEY_PPAGE, ord("h"), curses.KEY_LEFT}
+PAGE_DOWN = {ord("l"), ord(" ")}
+PAGE_UP = {ord("h")}
 CH_NEXT = {ord("n")}
 CH_PREV = {ord("p")}
-CH_HOME = {curses.KEY_HOME, ord("g")}
-CH_END = {curses.KEY_END, ord("G")}
+CH_HOME = {ord("g")}
+CH_END = {ord("G")}
 SHRINK = ord("-")
 WIDEN = ord("+")
 WIDTH = ord("=")
@@ -88,9 +110,23 @@ QUIT = {ord("q"), 3, 27, 304}
 HELP = {ord("?")}
 MARKPOS = ord("b")
 JUMPTOPOS = ord("`")
+JUMPTOPCTG = ord("%")
 COLORSWITCH = ord("c")
 
 
+def init_curses():
+    # import curses for the reader and add its keys to the bindings above,
+    # "import epr" alone doesn't load it
+    global curses
+    import curses
+    SCROLL_DOWN.add(curses.KEY_DOWN)
+    SCROLL_UP.add(curses.KEY_UP)
+    PAGE_DOWN.update({curses.KEY_NPAGE, curses.KEY_RIGHT})
+    PAGE_UP.update({curses.KEY_PPAGE, curses.KEY_LEFT})
+    CH_HOME.add(curses.KEY_HOME)
+    CH_END.add(curses.KEY_END)
+
+
 # colorscheme
 # DARK/LIGHT = (fg, bg)
 # -1 is default terminal fg/bg
@@ -100,12 +136,27 @@ LIGHT = (239, 223)
 
 # some global envs, better leave these alone
 STATEFILE = ""
+STATEDB = None
 STATE = {}
 LINEPRSRV = 0  # default = 2
 COLORSUPPORT = False
 SEARCHPATTERN = None
 VWR = None
+MEDIA = None  # MediaCache of images extracted this session
 JUMPLIST = {}
+CACHESIZE = 64 * 1024 * 1024  # bytes, in-memory chapter cache
+CACHEDIR = ""
+DISKCACHE = True
+DISKCACHESIZE = 256 * 1024 * 1024  # bytes, on-disk chapter cache
+DISKCACHEUSED = None
+STREAMSIZE = 1024 * 1024  # bytes, bigger chapters are painted while parsing
+STREAMCHUNK = 64 * 1024  # bytes fed to the parser per step
+PREFETCH = "thread"  # thread, process or off
+PREFETCHPREV = True  # also prefetch previous chapter
+TRACE = None  # JSON lines file for --trace
+TRACEREC = None  # record of the chapter being opened
+TTYBYTES = None  # bytes written to the terminal, only counted while tracing
+TRACEFRAME = None  # [key, start, paint time, TTYBYTES] of the frame on screen
 
 
 class Epub:
@@ -118,6 +169,8 @@ class Epub:
     }
 
     def __init__(self, fileepub):
+        import zipfile
+        import xml.etree.ElementTree as ET
         self.path = os.path.abspath(fileepub)
         self.file = zipfile.ZipFile(fileepub, "r")
         cont = ET.parse(self.file.open("META-INF/container.xml"))
@@ -127,9 +180,12 @@ class Epub:
         ).attrib["full-path"]
         self.rootdir = os.path.dirname(self.rootfile)\
             + "/" if os.path.dirname(self.rootfile) != "" else ""
-        cont = ET.parse(self.file.open(self.rootfile))
+        # OPF package document, parsed once and reused by
+        # initialize() and get_meta()
+        self.package = ET.parse(self.file.open(self.rootfile)).getroot()
+        cont = self.package
         # EPUB3
-        self.version = cont.getroot().get("version")
+        self.version = cont.get("version")
         if self.version == "2.0":
             # self.toc = self.rootdir + cont.find("OPF:manifest/*[@id='ncx']", self.NS).get("href")
             self.toc = self.rootdir\
@@ -144,42 +200,37 @@ class Epub:
                     self.NS
                 ).get("href")
 
+        st = os.stat(self.path)
+        self.fingerprint = "{}:{}:{}".format(self.path, st.st_size, st.st_mtime_ns)
+
         self.contents = []
         self.toc_entries = []
 
     def get_meta(self):
         meta = []
-        # why self.file.read(self.rootfile) problematic
-        cont = ET.fromstring(self.file.open(self.rootfile).read())
-        for i in cont.findall("OPF:metadata/*", self.NS):
+        for i in self.package.findall("OPF:metadata/*", self.NS):
             if i.text is not None:
                 meta.append([re.sub("{.*?}", "", i.tag), i.text])
         return meta
 
     def initialize(self):
-        cont = ET.parse(self.file.open(self.rootfile)).getroot()
-        manifest = []
+        import xml.etree.ElementTree as ET
+        cont = self.package
+        manifest = {}
         for i in cont.findall("OPF:manifest/*", self.NS):
             # EPUB3
             # if i.get("id") != "ncx" and i.get("properties") != "nav":
             if i.get("media-type") != "application/x-dtbncx+xml"\
                and i.get("properties") != "nav":
-                manifest.append([
-                    i.get("id"),
-                    i.get("href")
-                ])
+                manifest.setdefault(i.get("id"), i.get("href"))
 
-        spine, contents = [], []
+        contents = []
         for i in cont.findall("OPF:spine/*", self.NS):
-            spine.append(i.get("idref"))
-        for i in spine:
-            for j in manifest:
-                if i == j[0]:
-                    self.contents.append(self.rootdir+unquote(j[1]))
-                    contents.append(unquote(j[1]))
-                    manifest.remove(j)
-                    # TODO: test is break necessary
-                    break
+            # pop so that a duplicated idref is only read once
+            href = manifest.pop(i.get("idref"), None)
+            if href is not None:
+                self.contents.append(self.rootdir+unquote(href))
+                contents.append(unquote(href))
 
         toc = ET.parse(self.file.open(self.toc)).getroot()
         # EPUB3
@@ -190,23 +241,55 @@ class Epub:
                 "XHTML:body//XHTML:nav[@EPUB:type='toc']//XHTML:a",
                 self.NS
             )
-        for i in contents:
-            name = "-"
-            for j in navPoints:
-                # EPUB3
-                if self.version == "2.0":
-                    # if i == unquote(j.find("DAISY:content", self.NS).get("src")):
-                    if re.search(i, unquote(j.find("DAISY:content", self.NS).get("src"))) is not None:
-                        name = j.find("DAISY:navLabel/DAISY:text", self.NS).text
-                        break
-                elif self.version == "3.0":
-                    # if i == unquote(j.get("href")):
-                    if re.search(i, unquote(j.get("href"))) is not None:
-                        name = "".join(list(j.itertext()))
-                        break
+
+        # href (without fragment) -> label of its first navPoint, indexed by
+        # path inside the zip, by href as written and by basename as fallback
+        tocdir = posixpath.dirname(self.toc)
+        labels, rawlabels, baselabels = {}, {}, {}
+        for j in navPoints:
+            # EPUB3
+            if self.version == "2.0":
+                src = j.find("DAISY:content", self.NS)
+                src = "" if src is None else src.get("src", "")
+            elif self.version == "3.0":
+                src = j.get("href", "")
+            src = unquote(src).split("#")[0]
+            if src == "":
+                continue
+            if self.version == "2.0":
+                name = j.find("DAISY:navLabel/DAISY:text", self.NS)
+                name = None if name is None else name.text
+            elif self.version == "3.0":
+                name = "".join(list(j.itertext()))
+            labels.setdefault(posixpath.normpath(posixpath.join(tocdir, src)), name)
+            rawlabels.setdefault(src, name)
+            baselabels.setdefault(posixpath.basename(src), name)
+
+        for n, i in enumerate(contents):
+            path = posixpath.normpath(self.contents[n])
+            if path in labels:
+                name = labels[path]
+            elif i in rawlabels:
+                name = rawlabels[i]
+            else:
+                name = baselabels.get(posixpath.basename(i), "-")
             self.toc_entries.append(name)
 
 
+# re.sub(r"\s+", " ", text) without the regex: str.split() and \s agree
+# on what is whitespace
+def squeeze(text):
+    words = text.split()
+    if not words:
+        return " " if text else ""
+    line = " ".join(words)
+    if text[0].isspace():
+        line = " " + line
+    if text[-1].isspace():
+        line += " "
+    return line
+
+
 class HTMLtoLines(HTMLParser):
     para = {"p", "div"}
     inde = {"q", "dt", "dd", "blockquote"}
@@ -214,6 +297,7 @@ class HTMLtoLines(HTMLParser):
     bull = {"li"}
     hide = {"script", "style", "head"}
     # hide = {"script", "style", "head", ", "sub}
+    head = {"h1", "h2", "h3", "h4", "h5", "h6"}  # tag[:2], as re.match("h[1-6]")
 
     def __init__(self):
         HTMLParser.__init__(self)
@@ -228,9 +312,11 @@ class HTMLtoLines(HTMLParser):
         self.idinde = set()
         self.idbull = set()
         self.idpref = set()
+        self.idimg = set()  # paragraphs that are an [IMG:n] placeholder
+        self.cellcache = {}
 
     def handle_starttag(self, tag, attrs):
-        if re.match("h[1-6]", tag) is not None:
+        if tag[:2] in self.head:
             self.ishead = True
         elif tag in self.inde:
             self.isinde = True
@@ -252,6 +338,7 @@ class HTMLtoLines(HTMLParser):
                 if (tag == "img" and i[0] == "src")\
                    or (tag == "image" and i[0].endswith("href")):
                     self.text.append("[IMG:{}]".format(len(self.imgs)))
+                    self.idimg.add(len(self.text)-1)
                     self.imgs.append(unquote(i[1]))
 
     def handle_startendtag(self, tag, attrs):
@@ -262,11 +349,12 @@ class HTMLtoLines(HTMLParser):
                 if (tag == "img" and i[0] == "src")\
                    or (tag == "image" and i[0].endswith("href")):
                     self.text.append("[IMG:{}]".format(len(self.imgs)))
+                    self.idimg.add(len(self.text)-1)
                     self.imgs.append(unquote(i[1]))
                     self.text.append("")
 
     def handle_endtag(self, tag):
-        if re.match("h[1-6]", tag) is not None:
+        if tag[:2] in self.head:
             self.text.append("")
             self.text.append("")
             self.ishead = False
@@ -300,7 +388,7 @@ class HTMLtoLines(HTMLParser):
             if self.ispref:
                 line = unescape(tmp)
             else:
-                line = unescape(re.sub(r"\s+", " ", tmp))
+                line = unescape(squeeze(tmp))
             self.text[-1] += line
             if self.ishead:
                 self.idhead.add(len(self.text)-1)
@@ -311,31 +399,1279 @@ class HTMLtoLines(HTMLParser):
             elif self.ispref:
                 self.idpref.add(len(self.text)-1)
 
-    def get_lines(self, width=0):
-        text = []
+    def get_lines(self, width=0, starts=None):
+        # starts, if given, gets the first wrapped line of each paragraph
         if width == 0:
             return self.text
-        for n, i in enumerate(self.text):
+        text = LineStore()
+        self.wrap_lines(width, text, starts)
+        text.close()
+        return text, self.imgs
+
+    def cells(self, n):
+        # display widths of paragraph n, memoized as it is rewrapped
+        # at every width change
+        i = self.text[n]
+        if i.isascii():
+            return None
+        if n not in self.cellcache:
+            self.cellcache[n] = cellwidths(i)
+        return self.cellcache[n]
+
+    def wrap_lines(self, width, text, starts=None, first=0, last=None):
+        # wrap paragraphs [first, last) appending to LineStore text
+        out, flags = [], []
+        for n in range(first, len(self.text) if last is None else last):
+            i = self.text[n]
+            if starts is not None:
+                starts.append(len(text) + len(out))
             if n in self.idhead:
-                text += [i.rjust(width//2 + len(i)//2)] + [""]
+                cw = self.cells(n)
+                l = len(i) if cw is None else cw[-1]
+                tmp = [" " * (width//2 + l//2 - l) + i]
+                flag = LINE_HEAD
             elif n in self.idinde:
-                text += ["   "+j for j in textwrap.wrap(i, width - 3)] + [""]
+                tmp = ["   "+j for j in wrap_text(i, width - 3, self.cells(n))]
+                flag = LINE_INDE
             elif n in self.idbull:
-                tmp = textwrap.wrap(i, width - 3)
-                text += [" - "+j if j == tmp[0] else "   "+j for j in tmp] + [""]
+                tmp = wrap_text(i, width - 3, self.cells(n))
+                tmp = [" - "+j if j == tmp[0] else "   "+j for j in tmp]
+                flag = LINE_BULL
             elif n in self.idpref:
-                tmp = i.splitlines()
                 wraptmp = []
-                for line in tmp:
-                    wraptmp += [j for j in textwrap.wrap(line, width - 6)]
-                text += ["   "+j for j in wraptmp] + [""]
+                for line in i.splitlines():
+                    line = line.expandtabs()
+                    wraptmp += wrap_text(line, width - 6, cellwidths(line))
+                tmp = ["   "+j for j in wraptmp]
+                flag = LINE_PREF
             else:
-                text += textwrap.wrap(i, width) + [""]
-        return text, self.imgs
+                tmp = wrap_text(i, width, self.cells(n))
+                flag = 0
+            out += tmp + [""]
+            flags += [flag] * len(tmp) + [0]
+            # placeholders always open their own paragraph, see handle_*tag()
+            if tmp and n in self.idimg:
+                flags[-len(tmp)-1] |= LINE_IMG
+            # flush in blocks so the str list never holds a whole chapter
+            if len(out) >= 4096:
+                text.extend(out, flags)
+                out, flags = [], []
+        text.extend(out, flags)
+
+
+# numeric references html.unescape() remaps or drops (C1 controls,
+# noncharacters) but expat decodes as is
+CHARREF = re.compile(rb"&#(?:[xX]([0-9a-fA-F]+)|([0-9]+));")
+MARKUP = re.compile(rb"<[^>]*>")
+
+
+def xhtml_to_lines(content):
+    # HTMLtoLines fed by expat instead of HTMLParser: same handlers called
+    # with the same tags, attrs and data chunks, so the output is identical.
+    # Returns None if content isn't well-formed XML or reads differently
+    # as XML (CRs in <pre>, see CHARREF), the caller then uses HTMLParser.
+    import xml.parsers.expat
+    if b"\r" in content and b"<pre" in content:
+        return None
+    if b"&#" in content:
+        for m in CHARREF.finditer(content):
+            n = int(m.group(1), 16) if m.group(1) else int(m.group(2))
+            if 0x7f <= n <= 0x9f or 0xfdd0 <= n <= 0xfdef or n & 0xfffe == 0xfffe:
+                return None
+
+    parser = HTMLtoLines()
+    data = []
+    # start tag held back until the next event tells whether it is
+    # self-closing, HTMLParser reports those as handle_startendtag()
+    pending = []
+    incdata = False
+    root = None
+
+    def flush():
+        if pending:
+            parser.handle_starttag(*pending.pop())
+        if data:
+            parser.handle_data("".join(data))
+            data.clear()
+
+    def outside(raw):
+        # text around the root element, expat drops it but HTMLParser passes
+        # it on (a BOM, then whitespace) and it can end up in a paragraph
+        if b"<!--" in raw or b"[" in raw:
+            raise ValueError("prolog too complex")
+        for i in MARKUP.split(raw):
+            if i:
+                parser.handle_data(i.decode("utf-8"))
+
+    def start(name, attrs):
+        nonlocal root
+        if root is None:
+            root = name
+            outside(content[:xp.CurrentByteIndex])
+        flush()
+        pending.append((name.lower(), [
+            (attrs[i].lower(), attrs[i+1]) for i in range(0, len(attrs), 2)
+        ]))
+
+    def end(name):
+        i = xp.CurrentByteIndex
+        # "<a/>" ends right after "/>", "<a></a>" at "</a>"
+        if pending and content[i-2:i] == b"/>":
+            parser.handle_startendtag(*pending.pop())
+        else:
+            flush()
+            parser.handle_endtag(name.lower())
+
+    def text(d):
+        if not incdata:
+            if pending:
+                flush()
+            data.append(d)
+
+    def entity(name, isparam):
+        # HTML named references, undeclared in XHTML without its DTD
+        text(unescape("&" + name + ";"))
+
+    def cdata():
+        nonlocal incdata
+        flush()
+        incdata = not incdata
+
+    xp = xml.parsers.expat.ParserCreate("utf-8")
+    xp.ordered_attributes = True
+    xp.UseForeignDTD(True)
+    xp.StartElementHandler = start
+    xp.EndElementHandler = end
+    xp.CharacterDataHandler = text
+    xp.SkippedEntityHandler = entity
+    xp.CommentHandler = lambda d: flush()
+    xp.ProcessingInstructionHandler = lambda t, d: flush()
+    xp.StartCdataSectionHandler = xp.EndCdataSectionHandler = cdata
+    try:
+        xp.Parse(content, True)
+        flush()
+        i = content.rfind(b"</" + root.encode("utf-8"))
+        if i != -1:
+            outside(content[content.index(b">", i)+1:])
+    except (xml.parsers.expat.ExpatError, ValueError):
+        return None
+    finally:
+        # the handlers close over xp, free it without waiting for gc
+        xp = None
+    return parser
+
+
+def html_to_lines(content):
+    # the lenient path for tag soup, parses what it can
+    content = content.decode("utf-8")
+    parser = HTMLtoLines()
+    try:
+        parser.feed(content)
+        parser.close()
+    except:
+        pass
+    return parser
+
+
+# terminal cells taken by c: 0 for combining marks and format characters,
+# 2 for east asian wide and fullwidth characters
+def charwidth(c):
+    import unicodedata
+    if unicodedata.combining(c) or unicodedata.category(c) in {"Mn", "Me", "Cf"}:
+        return 0
+    return 2 if unicodedata.east_asian_width(c) in {"W", "F"} else 1
+
+
+# prefix sums of display widths (cw[k] is the width of text[:k]),
+# or None when every character takes exactly one cell
+def cellwidths(text):
+    from array import array
+    from itertools import accumulate
+    widths = {c: charwidth(c) for c in set(text) if not c.isascii()}
+    if all(w == 1 for w in widths.values()):
+        return None
+    cw = array("I", [0])
+    cw.extend(accumulate(widths.get(c, 1) for c in text))
+    return cw
+
+
+# where textwrap may break besides spaces: after a hyphen inside a word,
+# and before or after a run of dashes
+HYPHENBREAK = re.compile(r"(?<=[^\d\W]{2})-(?=[^\d\W]-?[^\d\W])|(?<=\w)(?=-{2,}\w)|(?<=\w)-{2,}(?=\w)")
+
+
+# last position p in (a, b] where text[a:p] can end a line, or -1
+def lastbreak(text, a, b, cw=None):
+    brk = text.rfind(" ", a, b + 1)
+    if text[a:brk].strip(" ") == "":
+        brk = -1
+    if text.find("-", a, b + 1) != -1:
+        for m in HYPHENBREAK.finditer(text, a + 1, b + 3):
+            if m.end() > b:
+                break
+            brk = max(brk, m.end())
+    if cw is not None:
+        # before or after any wide character
+        for p in range(b, max(a, brk), -1):
+            if cw[p] - cw[p-1] == 2 or (p < len(text) and cw[p+1] - cw[p] == 2):
+                return p
+    return brk
+
+
+# greedy linear wrap: each line end is found by bisecting the prefix widths
+# (or adding to the start column) and searching back for a break, so the
+# cost grows with the number of lines rather than words. Breaks match
+# textwrap: at spaces, after hyphens inside words, around dashes, and a
+# chunk too long for any line fills up the current one; lines may also
+# end before or after a wide (CJK) character.
+def wrap_text(text, width, cw=None):
+    if text.strip(" ") == "":
+        return []
+    width = max(width, 1)
+    lines = []
+    pos, end = 0, len(text)
+
+    def limit(p):
+        if cw is None:
+            return p + width
+        return bisect_right(cw, cw[p] + width, p) - 1
+
+    while pos < end:
+        lim = limit(pos)
+        if lim >= end:
+            lines.append(text[pos:].rstrip(" "))
+            break
+        brk = lastbreak(text, pos, lim, cw)
+        c = max(brk, pos)
+        while c < end and text[c] == " ":
+            c += 1
+        clim = limit(c)
+        if clim < end and lastbreak(text, c, clim, cw) <= c:
+            brk = lim
+            h = text.rfind("-", c, lim)
+            if h > c and text[c:h].strip("-") != "":
+                brk = h + 1
+        brk = max(brk, pos + 1)
+        line = text[pos:brk].rstrip(" ")
+        if line != "":
+            lines.append(line)
+        pos = brk
+        while pos < end and text[pos] == " ":
+            pos += 1
+    return lines
+
+
+# per line flags of LineStore
+LINE_HEAD = 1
+LINE_INDE = 2
+LINE_BULL = 4
+LINE_PREF = 8
+LINE_IMG = 16
+LINE_END = 32  # last line of a fully wrapped chapter
+
+
+# wrapped lines of a chapter as one text buffer per extend() plus arrays of
+# line offsets and flags, instead of a list of str objects (~50 bytes of
+# overhead each); indexing and slicing return str like a list would
+class LineStore:
+    def __init__(self):
+        from array import array
+        self.blocks = []
+        self.bstarts = array("Q")
+        self.offsets = array("Q", [0])
+        self.flags = array("B")
+
+    def extend(self, lines, flags):
+        if not lines:
+            return
+        block = "".join(lines)
+        base = self.offsets[-1]
+        self.blocks.append(block)
+        self.bstarts.append(base)
+        pos = base
+        for i in lines:
+            pos += len(i)
+            self.offsets.append(pos)
+        self.flags.extend(flags)
+
+    def close(self):
+        if len(self.flags) != 0:
+            self.flags[-1] |= LINE_END
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __iter__(self):
+        return (self[n] for n in range(len(self)))
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self[i] for i in range(*n.indices(len(self)))]
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError("line index out of range")
+        a, b = self.offsets[n], self.offsets[n+1]
+        if a == b:
+            return ""
+        blk = bisect_right(self.bstarts, a) - 1
+        base = self.bstarts[blk]
+        return self.blocks[blk][a - base:b - base]
+
+    def imgno(self, n):
+        # image index of a LINE_IMG line, which starts with the placeholder
+        # (or a heading's centering spaces)
+        i = self[n]
+        a = i.index("[IMG:") + 5
+        return int(i[a:i.index("]", a)])
+
+
+# LRU of parsed chapters (width 0) and wrapped lines (width > 0)
+# keyed by (book path, chapter index, width), bounded by approximate bytes
+class ChapterCache:
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+
+    def get(self, key):
+        try:
+            value, _ = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self.data:
+            self.size -= self.data.pop(key)[1]
+        size = sizeof(value)
+        if size > self.maxsize:
+            return
+        while self.size + size > self.maxsize:
+            self.size -= self.data.popitem(last=False)[1][1]
+        self.data[key] = value, size
+        self.size += size
+
+    def clear(self):
+        self.data.clear()
+        self.size = 0
+
+
+def sizeof(obj):
+    if isinstance(obj, HTMLtoLines):
+        return sizeof(obj.text) + sizeof(obj.imgs) + sum(
+            sizeof(i) for i in (obj.idhead, obj.idinde, obj.idbull, obj.idpref, obj.idimg)
+        ) + sys.getsizeof(obj.cellcache) + sum(
+            sys.getsizeof(i) for i in obj.cellcache.values()
+        )
+    elif isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(sizeof(i) for i in obj)
+    elif isinstance(obj, LineStore):
+        return sizeof(obj.blocks) + sum(
+            sys.getsizeof(i) for i in (obj.bstarts, obj.offsets, obj.flags)
+        )
+    return sys.getsizeof(obj)
+
+
+CHAPTERCACHE = ChapterCache(CACHESIZE)
+
+
+def loadcache():
+    global CACHEDIR
+    if os.getenv("XDG_CACHE_HOME") is not None:
+        CACHEDIR = os.path.join(os.getenv("XDG_CACHE_HOME"), "epr")
+    elif os.getenv("HOME") is not None:
+        CACHEDIR = os.path.join(os.getenv("HOME"), ".cache", "epr")
+    elif os.getenv("LOCALAPPDATA") is not None:
+        CACHEDIR = os.path.join(os.getenv("LOCALAPPDATA"), "epr", "cache")
+    else:
+        CACHEDIR = ""
+
+
+def clearcache():
+    if CACHEDIR != "" and os.path.isdir(CACHEDIR):
+        shutil.rmtree(CACHEDIR, ignore_errors=True)
+
+
+def parser_data(parser):
+    return (
+        parser.text, parser.imgs,
+        parser.idhead, parser.idinde, parser.idbull, parser.idpref,
+        parser.idimg
+    )
+
+
+def parser_from(data):
+    parser = HTMLtoLines()
+    parser.text, parser.imgs = data[0], data[1]
+    parser.idhead, parser.idinde, parser.idbull, parser.idpref, parser.idimg = data[2:]
+    return parser
+
+
+# on-disk entry: magic + marshal version + format + zlib(marshal(parser
+# output)), format 2 added idimg
+CACHEMAGIC = b"EPRC" + bytes([marshal.version, 2])
+
+
+def cachefile(ebook, chpath):
+    import hashlib
+    key = hashlib.sha1((ebook.fingerprint + "\0" + chpath).encode("utf-8"))
+    return os.path.join(CACHEDIR, key.hexdigest())
+
+
+def getcache(ebook, chpath):
+    if not DISKCACHE or CACHEDIR == "":
+        return None
+    path = cachefile(ebook, chpath)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    try:
+        if not data.startswith(CACHEMAGIC):
+            raise ValueError
+        import zlib
+        parser = parser_from(marshal.loads(zlib.decompress(data[len(CACHEMAGIC):])))
+    except Exception:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    # touch it so that eviction drops least recently used entries first
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return parser
+
+
+def putcache(ebook, chpath, parser):
+    global DISKCACHEUSED
+    if not DISKCACHE or CACHEDIR == "":
+        return
+    import tempfile
+    import zlib
+    data = CACHEMAGIC + zlib.compress(marshal.dumps(parser_data(parser)))
+    path = cachefile(ebook, chpath)
+    try:
+        os.makedirs(CACHEDIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHEDIR, prefix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        return
+    if DISKCACHEUSED is None:
+        DISKCACHEUSED = sum(i.stat().st_size for i in os.scandir(CACHEDIR) if i.is_file())
+    else:
+        DISKCACHEUSED += len(data)
+    if DISKCACHEUSED > DISKCACHESIZE:
+        prunecache()
+
+
+def prunecache():
+    global DISKCACHEUSED
+    entries = []
+    for i in os.scandir(CACHEDIR):
+        if i.is_file():
+            st = i.stat()
+            entries.append((st.st_mtime, st.st_size, i.path))
+    entries.sort()
+    DISKCACHEUSED = sum(i[1] for i in entries)
+    # drop down to 3/4 of the limit so that pruning doesn't run on every write
+    while entries and DISKCACHEUSED > DISKCACHESIZE * 3 // 4:
+        _, size, path = entries.pop(0)
+        try:
+            os.remove(path)
+            DISKCACHEUSED -= size
+        except OSError:
+            pass
+
+
+def parse_chapter(ebook, chpath):
+    if TRACE is not None: t = time.perf_counter()
+    parser = getcache(ebook, chpath)
+    if parser is not None:
+        if TRACE is not None: trace_stage("disk", t, "disk")
+        return parser
+    content = ebook.file.open(chpath).read()
+    if TRACE is not None: t = trace_stage("read", t, "miss")
+    parser = xhtml_to_lines(content)
+    if parser is None:
+        parser = html_to_lines(content)
+        if TRACE is not None: t = trace_stage("feed-html", t)
+    elif TRACE is not None: t = trace_stage("feed-xml", t)
+    putcache(ebook, chpath, parser)
+    if TRACE is not None: trace_stage("store", t)
+    return parser
+
+
+def load_parsed(ebook, index):
+    key = (ebook.path, index, 0)
+    parser = CHAPTERCACHE.get(key)
+    if parser is None:
+        parser = parse_chapter(ebook, ebook.contents[index])
+        CHAPTERCACHE.put(key, parser)
+    elif TRACE is not None:
+        trace_stage("parsed", time.perf_counter(), "memory-parsed")
+    return parser
+
+
+def wrap_chapter(parser, width):
+    starts = []
+    lines, imgs = parser.get_lines(width, starts)
+    return lines, imgs, starts
+
+
+def load_chapter(ebook, index, width):
+    key = (ebook.path, index, width)
+    lines = CHAPTERCACHE.get(key)
+    if lines is None:
+        parser = load_parsed(ebook, index)
+        if TRACE is not None: t = time.perf_counter()
+        lines = wrap_chapter(parser, width)
+        if TRACE is not None: trace_stage("get_lines", t)
+        CHAPTERCACHE.put(key, lines)
+    elif TRACE is not None:
+        trace_stage("wrapped", time.perf_counter(), "memory")
+    return lines
+
+
+# feeds a big chapter to HTMLtoLines in chunks straight from the zip stream,
+# wrapping paragraphs as soon as they are complete, so reader() can paint
+# the first screen early and step through the rest while waiting for keys
+class ChapterStream:
+    def __init__(self, ebook, index, width):
+        import codecs
+        self.ebook = ebook
+        self.index = index
+        self.width = width
+        self.file = ebook.file.open(ebook.contents[index])
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.parser = HTMLtoLines()
+        self.lines, self.starts = LineStore(), []
+        self.imgs = self.parser.imgs
+        self.done = False
+
+    @staticmethod
+    def wanted(ebook, index, width):
+        chpath = ebook.contents[index]
+        if (ebook.path, index, width) in CHAPTERCACHE.data\
+           or (ebook.path, index, 0) in CHAPTERCACHE.data:
+            return False
+        if DISKCACHE and CACHEDIR != "" and os.path.exists(cachefile(ebook, chpath)):
+            return False
+        try:
+            return ebook.file.getinfo(chpath).file_size > STREAMSIZE
+        except KeyError:
+            return False
+
+    def step(self):
+        chunk = self.file.read(STREAMCHUNK)
+        final = chunk == b""
+        try:
+            self.parser.feed(self.decoder.decode(chunk, final))
+            if final:
+                self.parser.close()
+        except:
+            # as in parse_chapter(), keep whatever was parsed so far
+            final = True
+        # the last paragraph may still grow unless parsing is over
+        last = len(self.parser.text) - (0 if final else 1)
+        self.parser.wrap_lines(self.width, self.lines, self.starts, len(self.starts), last)
+        if final:
+            self.file.close()
+            self.lines.close()
+            self.done = True
+            CHAPTERCACHE.put((self.ebook.path, self.index, 0), self.parser)
+            CHAPTERCACHE.put((self.ebook.path, self.index, self.width), (self.lines, self.imgs, self.starts))
+            putcache(self.ebook, self.ebook.contents[self.index], self.parser)
+
+    def fill(self, n):
+        while not self.done and len(self.lines) < n:
+            self.step()
+
+    def finish(self):
+        while not self.done:
+            self.step()
+
+
+# --trace: every chapter opened by reader() appends one JSON line with the
+# duration of each stage until first paint; all tracing calls are guarded by
+# "if TRACE is not None" so they cost nothing when disabled
+def trace_begin(index):
+    global TRACEREC
+    TRACEREC = {
+        "time": time.time(),
+        "chapter": index,
+        "cache": None,
+        "stages": {},
+        "start": time.perf_counter()
+    }
+
+
+def trace_stage(stage, start, cache=None):
+    end = time.perf_counter()
+    # prefetch workers share the module, only trace what reader() waits for
+    if TRACEREC is None or threading.current_thread() is not threading.main_thread():
+        return end
+    TRACEREC["stages"][stage] = TRACEREC["stages"].get(stage, 0) + end - start
+    if cache is not None and TRACEREC["cache"] is None:
+        TRACEREC["cache"] = cache
+    return end
+
+
+def trace_end(lines):
+    global TRACEREC
+    rec, TRACEREC = TRACEREC, None
+    if rec is None:
+        return
+    rec["stages"]["total"] = time.perf_counter() - rec.pop("start")
+    rec["lines"] = lines
+    rec["lru"] = [CHAPTERCACHE.hits, CHAPTERCACHE.misses]
+    TRACE.write(json.dumps(rec) + "\n")
+    TRACE.flush()
+
+
+# every frame painted by reader() and searching() also appends a JSON line
+# with the bytes curses sent to the terminal for it. A frame's bytes are
+# written out when the next frame starts: a key press came in between, so
+# the forwarding thread of ttycount() has drained them by then
+def trace_frame(key):
+    global TRACEFRAME
+    if TRACEFRAME is not None:
+        fkey, _, paint, before = TRACEFRAME
+        TRACE.write(json.dumps({
+            "frame": fkey,
+            "bytes": TTYBYTES - before,
+            "paint": paint
+        }) + "\n")
+        TRACE.flush()
+    TRACEFRAME = None if key is None else [key, time.perf_counter(), 0, TTYBYTES]
+
+
+def trace_painted():
+    if TRACEFRAME is not None:
+        TRACEFRAME[2] = time.perf_counter() - TRACEFRAME[1]
+
+
+# route fd 1 through a pipe, a thread forwards it to the terminal and counts
+# the bytes; curses still finds its tty on stdin and stderr
+def ttycount():
+    global TTYBYTES
+    real = os.dup(1)
+    r, w = os.pipe()
+    os.dup2(w, 1)
+    os.close(w)
+    TTYBYTES = 0
+
+    def forward():
+        global TTYBYTES
+        while True:
+            data = os.read(r, 65536)
+            if not data:
+                break
+            TTYBYTES += len(data)
+            while data:
+                data = data[os.write(real, data):]
+
+    thread = threading.Thread(target=forward, daemon=True)
+    thread.start()
+
+    def stop():
+        trace_frame(None)
+        sys.stdout.flush()
+        # closes the write end, forward() gets EOF once the pipe is drained
+        os.dup2(real, 1)
+        thread.join(1)
+
+    atexit.register(stop)
+
+
+def trace_summary(file):
+    stages, caches, n = {}, {}, 0
+    frames = {}
+    with open(file) as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if "frame" in rec:
+                key = rec["frame"]
+                if isinstance(key, int):
+                    key = chr(key) if 32 < key < 127 else str(key)
+                frames.setdefault(key, []).append(rec["bytes"])
+                continue
+            n += 1
+            caches[rec["cache"]] = caches.get(rec["cache"], 0) + 1
+            for i, t in rec["stages"].items():
+                stages.setdefault(i, []).append(t * 1000)
+
+    def pct(data, p):
+        return data[min(len(data) - 1, int(p * len(data)))]
+
+    print("{} chapters opened".format(n))
+    print("cache: " + ", ".join("{} {}".format(i, j) for i, j in sorted(caches.items(), key=str)))
+    print()
+    print("{:<14}{:>7}{:>10}{:>10}{:>10}{:>10}".format("stage (ms)", "count", "p50", "p90", "p99", "max"))
+    for i, data in sorted(stages.items(), key=lambda x: x[0] == "total"):
+        data.sort()
+        print("{:<14}{:>7}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+            i, len(data), pct(data, .5), pct(data, .9), pct(data, .99), data[-1]
+        ))
+    if frames:
+        print()
+        print("{:<14}{:>7}{:>10}{:>10}{:>10}{:>10}".format("frame (bytes)", "count", "p50", "p90", "max", "total"))
+        for i, data in sorted(frames.items(), key=lambda x: -len(x[1])):
+            data.sort()
+            print("{:<14}{:>7}{:>10}{:>10}{:>10}{:>10}".format(
+                i, len(data), pct(data, .5), pct(data, .9), data[-1], sum(data)
+            ))
+
+
+# books opened by prefetch workers, each worker has its own zip handle
+WORKEREPUBS = {}
+
+
+def prefetch_init(cachedir, diskcache):
+    global CACHEDIR, DISKCACHE
+    CACHEDIR, DISKCACHE = cachedir, diskcache
+
+
+def worker_epub(path):
+    ebook = WORKEREPUBS.get(path)
+    if ebook is None:
+        ebook = Epub(path)
+        ebook.initialize()
+        WORKEREPUBS[path] = ebook
+    return ebook
+
+
+def prefetch_worker(path, index, width):
+    ebook = worker_epub(path)
+    parser = parse_chapter(ebook, ebook.contents[index])
+    return parser_data(parser), wrap_chapter(parser, width)
+
+
+def dump_worker(path, index, width):
+    ebook = worker_epub(path)
+    parser = parse_chapter(ebook, ebook.contents[index])
+    if width == 0:
+        return "".join(i + "\n\n" for i in parser.get_lines())
+    return "".join(i + "\n" for i in parser.get_lines(width)[0])
+
+
+def dump_epub(file, width=0, outdir=None, jobs=None):
+    epub = Epub(file)
+    epub.initialize()
+    tasks = [(epub.path, n, width) for n in range(len(epub.contents))]
+    jobs = jobs or os.cpu_count() or 1
+
+    # chapters are parsed across a process pool but written in spine order,
+    # with at most 2*jobs chapters in flight to keep memory bounded
+    if jobs == 1 or len(tasks) <= 1:
+        WORKEREPUBS[epub.path] = epub
+        chapters = (dump_worker(*i) for i in tasks)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        def ordered():
+            with ProcessPoolExecutor(
+                max_workers=jobs,
+                initializer=prefetch_init,
+                initargs=(CACHEDIR, DISKCACHE)
+            ) as pool:
+                pending = deque()
+                for i in tasks:
+                    pending.append(pool.submit(dump_worker, *i))
+                    if len(pending) >= 2 * jobs:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+        chapters = ordered()
+
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+        d = len(str(len(tasks)))
+    out = sys.stdout.buffer
+    try:
+        for n, text in enumerate(chapters):
+            if outdir is None:
+                out.write(text.encode("utf-8"))
+            else:
+                with open(os.path.join(outdir, str(n+1).rjust(d, "0") + ".txt"), "wb") as f:
+                    f.write(text.encode("utf-8"))
+        out.flush()
+    except BrokenPipeError:
+        # stdout closed early, e.g. piped into head; point it at devnull so
+        # flushing it at exit doesn't raise again
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
+
+
+# library API: generators that need no curses and hold one chapter at a
+# time; each call opens its own Epub from the path, so they can run in
+# threads or in pool workers (pass chapters= to split a book among them)
+def iter_chapters(file, chapters=None):
+    # (index, ToC label, HTMLtoLines) of each chapter in spine order
+    ebook = Epub(file)
+    try:
+        ebook.initialize()
+        for n in range(len(ebook.contents)) if chapters is None else chapters:
+            yield n, ebook.toc_entries[n], parse_chapter(ebook, ebook.contents[n])
+    finally:
+        ebook.file.close()
+
+
+def iter_lines(file, width=80, chapters=None):
+    # (index, line) of the text wrapped at width as shown by the reader,
+    # (index, paragraph) if width is 0
+    for n, _, parser in iter_chapters(file, chapters):
+        if width == 0:
+            lines = parser.get_lines()
+        else:
+            lines = parser.get_lines(width)[0]
+        for i in lines:
+            yield n, i
+
+
+def iter_search(file, pattern, width=80, chapters=None):
+    # (index, [[line, col, len], ...]) of each match of pattern, a str is
+    # compiled like the reader's search (ignoring case, ^ and $ at each
+    # paragraph); line is the number of the line iter_lines() yields at
+    # the same width in that chapter
+    if isinstance(pattern, str):
+        pattern = re.compile(pattern, re.IGNORECASE | re.MULTILINE)
+    for n, _, parser in iter_chapters(file, chapters):
+        if width == 0:
+            lines = starts = None
+        else:
+            lines, _, starts = wrap_chapter(parser, width)
+        for i in search_chapter(parser, lines, starts, pattern):
+            yield n, i
+
+
+# parses and wraps adjacent chapters while reader() waits for keys,
+# results are moved into CHAPTERCACHE from the main thread
+class Prefetcher:
+    def __init__(self, mode):
+        self.mode = mode
+        self.pool = None
+        self.jobs = {}
+        self.counting = None
+
+    def schedule(self, ebook, index, width):
+        if self.mode == "off":
+            return
+        wanted = [index + 1]
+        if PREFETCHPREV:
+            wanted.append(index - 1)
+        wanted = [
+            (ebook.path, i, width) for i in wanted
+            if 0 <= i < len(ebook.contents)
+        ]
+        self.cancel(keep=wanted)
+        for key in wanted:
+            if key in self.jobs or key in CHAPTERCACHE.data:
+                continue
+            self.jobs[key] = self.executor().submit(prefetch_worker, *key)
+
+    def executor(self):
+        if self.pool is None:
+            from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+            if self.mode == "process":
+                self.pool = ProcessPoolExecutor(
+                    max_workers=2,
+                    initializer=prefetch_init,
+                    initargs=(CACHEDIR, DISKCACHE)
+                )
+            else:
+                self.pool = ThreadPoolExecutor(max_workers=1)
+            atexit.register(self.shutdown)
+        return self.pool
+
+    def count(self, index):
+        # fill a LineIndex one chapter per job, so the adjacent chapters
+        # scheduled above never wait behind the whole book
+        self.counting = index
+        if self.mode == "off" or index.job is not None:
+            return
+        n = index.missing()
+        if n is None:
+            return
+        try:
+            index.job = self.executor().submit(count_worker, index.path, n, index.width)
+        except RuntimeError:
+            # pool shut down at exit
+            return
+
+        def done(job):
+            index.job = None
+            if job.cancelled():
+                return
+            try:
+                index.counts[n] = job.result()
+            except Exception:
+                index.counts[n] = 0
+            # a newer index (width changed) takes over the pool
+            if self.counting is index:
+                self.count(index)
+        index.job.add_done_callback(done)
+
+    def take(self, key, wait=True):
+        # block only if the chapter about to be read is still in progress
+        for i in list(self.jobs):
+            job = self.jobs[i]
+            if (i != key or not wait) and not job.done():
+                continue
+            del self.jobs[i]
+            try:
+                data, lines = job.result()
+            except Exception:
+                continue
+            CHAPTERCACHE.put((i[0], i[1], 0), parser_from(data))
+            CHAPTERCACHE.put(i, lines)
+
+    def cancel(self, keep=()):
+        for i in list(self.jobs):
+            if i not in keep and self.jobs[i].cancel():
+                del self.jobs[i]
+
+    def shutdown(self):
+        self.cancel()
+        self.counting = None
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+
+PREFETCHER = Prefetcher(PREFETCH)
+
+
+def count_worker(path, index, width):
+    # parsing also warms the disk cache, only the count is kept
+    ebook = worker_epub(path)
+    parser = parse_chapter(ebook, ebook.contents[index])
+    return len(wrap_chapter(parser, width)[0])
+
+
+# wrapped line count of every chapter at one width, for progress through
+# the whole book and jumping to a share of it; counted in the background
+# by PREFETCHER, a chapter at a time, so no more than one chapter is
+# wrapped for it at once
+class LineIndex:
+    def __init__(self, ebook, width):
+        self.path = ebook.path
+        self.width = width
+        self.counts = [None] * len(ebook.contents)
+        self.job = None
+        # chapter reader() is streaming, its count comes when it finishes
+        self.streaming = None
+
+    def missing(self):
+        for n, i in enumerate(self.counts):
+            if i is None and n != self.streaming:
+                return n
+        return None
+
+    def complete(self, ebook):
+        # count what the background jobs haven't yet, in this thread
+        for n, i in enumerate(self.counts):
+            if i is not None:
+                continue
+            # peek at the cache without reordering it
+            key = (self.path, n, self.width)
+            if key in CHAPTERCACHE.data:
+                self.counts[n] = len(CHAPTERCACHE.data[key][0][0])
+                continue
+            key = (self.path, n, 0)
+            if key in CHAPTERCACHE.data:
+                parser = CHAPTERCACHE.data[key][0]
+            else:
+                parser = parse_chapter(ebook, ebook.contents[n])
+            self.counts[n] = len(wrap_chapter(parser, self.width)[0])
+
+    def locate(self, line, rows):
+        # chapter and top line showing book-wide line, kept off the
+        # blank space past a chapter's last page
+        line = max(0, min(line, sum(self.counts) - 1))
+        for n, i in enumerate(self.counts):
+            if line < i:
+                return n, min(line, pgend(i, rows))
+            line -= i
+
+    def progress(self, index, y, rows):
+        # share of the book read up to the last line on screen, estimated
+        # from the chapter number until every chapter is counted
+        tot = self.counts[index]
+        seen = min(y + rows, tot)
+        if None in self.counts:
+            return "~{}%".format(int(100 * (index + seen/tot) / len(self.counts)))
+        return "{}%".format(int(100 * (sum(self.counts[:index]) + seen) / sum(self.counts)))
+
+
+LINEINDEX = None
+
+
+# background tasks run on the main thread between keys by getkey(): name ->
+# [generator, time it wants to run next]; each next() does a slice of work
+# and yields None to go on or a number of seconds to sleep. Keys are polled
+# after every slice, so a slice's length is the most a key waits for
+IDLETASKS = {}
+SAVEDELAY = 1  # seconds of idling before the reading position is saved
+
+
+def idle(name, task):
+    # schedule generator task, replacing the one of the same name
+    IDLETASKS[name] = [task, 0]
+
+
+def getkey(win, wide=False, until=None):
+    # win.getch() (get_wch() if wide) that runs IDLETASKS until a key comes,
+    # or returns -1 once until(), if given, is true after a slice
+
+    def read():
+        if not wide:
+            return win.getch()
+        try:
+            return win.get_wch()
+        except curses.error:
+            return -1
+
+    try:
+        while IDLETASKS:
+            # the task due first, those done with a slice go to the back
+            name, task = min(IDLETASKS.items(), key=lambda i: i[1][1])
+            win.timeout(max(0, int((task[1] - time.perf_counter()) * 1000)))
+            k = read()
+            if k != -1:
+                return k
+            if task[1] > time.perf_counter():
+                continue
+            try:
+                sleep = next(task[0])
+            except StopIteration:
+                # unless the task rescheduled itself on the way out
+                if IDLETASKS.get(name) is task:
+                    del IDLETASKS[name]
+            else:
+                task[1] = time.perf_counter() + (sleep or 0)
+            if until is not None and until():
+                return -1
+        if until is not None and until():
+            return -1
+        win.timeout(-1)
+        return read()
+    finally:
+        win.timeout(-1)
+
+
+def harvesting():
+    # move finished prefetch results into CHAPTERCACHE while idle rather
+    # than when the chapter is opened
+    while PREFETCHER.jobs:
+        PREFETCHER.take(None, wait=False)
+        yield 0.1
+
+
+def saving(file, index, width, y, pctg):
+    # save the position once reading pauses, not only on quit
+    yield SAVEDELAY
+    savestate(file, index, width, y, pctg)
+
+
+def search_worker(path, pattern, flags, chapters, queue, cachedir, diskcache):
+    # runs in its own process so a runaway regex can be terminated; reports
+    # (chapter, match spans as [start, end, ...]) for chapters in that order
+    import signal
+    from array import array
+    # a forked worker inherits the handler ncurses puts on SIGTERM, which
+    # resets the terminal under the reader
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    prefetch_init(cachedir, diskcache)
+    pattern = re.compile(pattern, flags)
+    ebook = Epub(path)
+    try:
+        ebook.initialize()
+        for n in chapters:
+            spans = array("I")
+            try:
+                text = parse_chapter(ebook, ebook.contents[n]).text
+            except Exception:
+                # an unreadable chapter has no matches, the rest of the
+                # book is still searched
+                text = []
+            for m in pattern.finditer("\n".join(text)):
+                spans.extend(m.span())
+            queue.put((n, spans))
+    finally:
+        ebook.file.close()
+    queue.put((None, None))
+
+
+# search of a whole book for one pattern, run by search_worker() from the
+# chapter being read, then from the start; kept per pattern in SEARCHCACHE,
+# so n/N into another chapter or searching the same pattern again never
+# runs the regex twice
+class BookSearch:
+    def __init__(self, ebook, pattern, first=0):
+        import multiprocessing
+        self.chapters = len(ebook.contents)
+        self.spans = [None] * self.chapters
+        self.hits = 0
+        self.done = False
+        order = [first] + [i for i in range(self.chapters) if i != first]
+        self.queue = multiprocessing.Queue()
+        self.proc = multiprocessing.Process(
+            target=search_worker,
+            args=(ebook.path, pattern.pattern, pattern.flags, order, self.queue, CACHEDIR, DISKCACHE),
+            daemon=True
+        )
+        self.proc.start()
+
+    def poll(self):
+        # take in what the worker found so far, True if anything
+        import queue
+        from array import array
+        new = False
+        while not self.done:
+            # checked before reading, whatever a dead worker sent is in
+            # the queue by then
+            alive = self.proc.is_alive()
+            try:
+                n, spans = self.queue.get_nowait()
+            except queue.Empty:
+                if not alive:
+                    # it died (killed, out of memory, a broken book)
+                    # without finishing, the rest has no matches
+                    self.done = new = True
+                    self.spans = [array("I") if i is None else i for i in self.spans]
+                    self.proc.join()
+                break
+            new = True
+            if n is None:
+                self.done = True
+                self.proc.join()
+            else:
+                self.spans[n] = spans
+                self.hits += len(spans) // 2
+        return new
+
+    def polling(self):
+        # getkey() task
+        while not self.done:
+            self.poll()
+            yield 0.05
+
+    def cancel(self):
+        if not self.done:
+            self.proc.kill()
+            self.proc.join()
+
+    def find(self, index, step):
+        # next chapter with a match from index in direction step, None if
+        # there is none, False if the worker hasn't got there yet
+        index += step
+        while 0 <= index < self.chapters:
+            if self.spans[index] is None:
+                return False
+            if self.spans[index]:
+                return index
+            index += step
+        return None
+
+    def before(self, index):
+        # matches in the chapters before index, None until all are searched
+        if None in self.spans[:index]:
+            return None
+        return sum(len(i) for i in self.spans[:index]) // 2
+
+
+SEARCHCACHE = OrderedDict()
+SEARCHCACHESIZE = 8  # patterns
+
+
+def search_chapter(parser, lines, starts, pattern):
+    # match pattern against unwrapped paragraphs, see locate_matches()
+    spans = []
+    for m in pattern.finditer("\n".join(parser.text)):
+        spans += m.span()
+    return locate_matches(parser, lines, starts, spans)
+
+
+def locate_matches(parser, lines, starts, spans):
+    # spans ([start, end, ...]) are matches in the unwrapped paragraphs
+    # joined by newline, so matches spanning wrapped lines are found too;
+    # map each to [line, col, len] pieces of the wrapped lines, or of the
+    # paragraphs if lines is None
+    offsets, n = [], 0
+    for i in parser.text:
+        offsets.append(n)
+        n += len(i) + 1
+    segments = {}
+
+    def paragraph_segments(n):
+        if n in segments:
+            return segments[n]
+        para = parser.text[n]
+        if lines is None:
+            segments[n] = [(n, 0, 0, len(para))]
+            return segments[n]
+        end = starts[n+1] if n + 1 < len(starts) else len(lines)
+        segs, pos = [], 0
+        for l in range(starts[n], end):
+            line = lines[l]
+            if n in parser.idhead:
+                col = len(line) - len(para)
+            elif n in parser.idinde or n in parser.idbull or n in parser.idpref:
+                col = 3
+            else:
+                col = 0
+            content = line[col:]
+            if content == "":
+                continue
+            p = para.find(content, pos)
+            # tabs in <pre> are expanded when wrapping, give up on exact columns
+            if p == -1:
+                break
+            segs.append((l, p, col, len(content)))
+            pos = p + len(content)
+        segments[n] = segs
+        return segs
+
+    found = []
+    for a, b in zip(spans[::2], spans[1::2]):
+        first = bisect_right(offsets, a) - 1
+        pieces = []
+        for n in range(first, len(offsets)):
+            if offsets[n] > b or (offsets[n] == b and a != b):
+                break
+            p0, p1 = a - offsets[n], b - offsets[n]
+            for l, pos, col, ln in paragraph_segments(n):
+                s, e = max(p0, pos), min(p1, pos + ln)
+                if s < e or (p0 == p1 and pos <= p0 <= pos + ln):
+                    pieces.append([l, col + s - pos, e - s])
+            if a == b and pieces != []:
+                break
+        if pieces == []:
+            pieces = [[first if lines is None else starts[first], 0, 0]]
+        found.append(pieces)
+    return found
 
 
 def loadstate():
-    global STATE, STATEFILE
+    global STATE, STATEFILE, STATEDB
+    import sqlite3
     if os.getenv("HOME") is not None:
         STATEFILE = os.path.join(os.getenv("HOME"), ".epr")
         if os.path.isdir(os.path.join(os.getenv("HOME"), ".config")):
@@ -351,9 +1687,89 @@ def loadstate():
     else:
         STATEFILE = os.devnull
 
-    if os.path.exists(STATEFILE):
+    # reading states live in an SQLite file next to the old JSON config so that
+    # saving touches one row and concurrent sessions don't overwrite each other
+    dbfile = ":memory:" if STATEFILE == os.devnull else STATEFILE + ".db"
+    STATEDB = sqlite3.connect(dbfile, timeout=10)
+    with STATEDB:
+        STATEDB.execute(
+            "CREATE TABLE IF NOT EXISTS reading_state ("
+            "filepath TEXT PRIMARY KEY, idx INTEGER, width INTEGER, "
+            "pos INTEGER, pctg REAL, lastread REAL DEFAULT 0, "
+            "title TEXT, author TEXT)"
+        )
+        cols = {i[1] for i in STATEDB.execute("PRAGMA table_info(reading_state)")}
+        for i in ("title", "author"):
+            if i not in cols:
+                STATEDB.execute("ALTER TABLE reading_state ADD COLUMN {} TEXT".format(i))
+        # trigrams of basename, title and author for "epr STRINGS"
+        STATEDB.execute(
+            "CREATE TABLE IF NOT EXISTS history_trigram ("
+            "gram TEXT, filepath TEXT, PRIMARY KEY (gram, filepath)) WITHOUT ROWID"
+        )
+        STATEDB.execute("CREATE INDEX IF NOT EXISTS history_trigram_file ON history_trigram (filepath)")
+        STATEDB.execute("CREATE TABLE IF NOT EXISTS history_gram (gram TEXT PRIMARY KEY, n INTEGER)")
+        # catalog written by --index
+        STATEDB.execute(
+            "CREATE TABLE IF NOT EXISTS library ("
+            "filepath TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, title TEXT, "
+            "author TEXT, spine INTEGER, contents TEXT, toc TEXT)"
+        )
+    migratestate()
+    with STATEDB:
+        for i in STATEDB.execute(
+            "SELECT filepath, title, author FROM reading_state r WHERE NOT EXISTS "
+            "(SELECT 1 FROM history_trigram t WHERE t.filepath = r.filepath)"
+        ).fetchall():
+            indexhistory(*i)
+
+    STATE, last = {}, None
+    for row in STATEDB.execute(
+        "SELECT filepath, idx, width, pos, pctg, lastread, title, author "
+        "FROM reading_state ORDER BY rowid"
+    ):
+        # metadata saved for a book that never got a reading state
+        if row[1] is None:
+            continue
+        STATE[row[0]] = {
+            "lastread": str(0),
+            "index": str(row[1]),
+            "width": str(row[2]),
+            "pos": str(row[3]),
+            "pctg": str(row[4]),
+            "title": row[6],
+            "author": row[7]
+        }
+        if row[5] > 0 and (last is None or row[5] >= last[1]):
+            last = row[0], row[5]
+    if last is not None:
+        STATE[last[0]]["lastread"] = str(1)
+
+
+def migratestate():
+    # import and retire JSON config written by previous versions
+    if STATEFILE == os.devnull or not os.path.isfile(STATEFILE):
+        return
+    try:
         with open(STATEFILE, "r") as f:
-            STATE = json.load(f)
+            old = json.load(f)
+    except ValueError:
+        return
+    with STATEDB:
+        for n, (i, j) in enumerate(old.items()):
+            try:
+                row = (
+                    int(j["index"]), int(j["width"]), int(j["pos"]),
+                    float(j.get("pctg", 0)), time.time() if j.get("lastread") == "1" else n / 1e9
+                )
+            except (KeyError, ValueError):
+                continue
+            STATEDB.execute("INSERT OR IGNORE INTO reading_state (filepath) VALUES (?)", (i,))
+            STATEDB.execute(
+                "UPDATE reading_state SET idx = ?, width = ?, pos = ?, pctg = ?, lastread = ? "
+                "WHERE filepath = ?", row + (i,)
+            )
+    os.replace(STATEFILE, STATEFILE + ".bak")
 
 
 def savestate(file, index, width, pos, pctg ):
@@ -364,8 +1780,212 @@ def savestate(file, index, width, pos, pctg ):
     STATE[file]["width"] = str(width)
     STATE[file]["pos"] = str(pos)
     STATE[file]["pctg"] = str(pctg)
-    with open(STATEFILE, "w") as f:
-        json.dump(STATE, f, indent=4)
+    with STATEDB:
+        STATEDB.execute("INSERT OR IGNORE INTO reading_state (filepath) VALUES (?)", (file,))
+        STATEDB.execute(
+            "UPDATE reading_state SET idx = ?, width = ?, pos = ?, pctg = ?, lastread = ? "
+            "WHERE filepath = ?", (index, width, pos, pctg, time.time(), file)
+        )
+
+
+def index_worker(path, warm):
+    # catalog row, and bytes the book takes in the disk cache if warm
+    st = os.stat(path)
+    ebook = Epub(path)
+    ebook.initialize()
+    meta = dict(ebook.get_meta())
+    size = 0
+    if warm:
+        for i in ebook.contents:
+            parse_chapter(ebook, i)
+            try:
+                size += os.path.getsize(cachefile(ebook, i))
+            except OSError:
+                pass
+    return (
+        ebook.path, st.st_size, st.st_mtime_ns, meta.get("title", ""), meta.get("creator", ""),
+        len(ebook.contents), json.dumps(ebook.contents), json.dumps(ebook.toc_entries)
+    ), size
+
+
+def index_library(directory, warm=False, jobs=None):
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    known, broken = {}, set()
+    for row in STATEDB.execute("SELECT filepath, size, mtime, spine FROM library"):
+        known[row[0]] = row[1:3]
+        if row[3] is None:
+            broken.add(row[0])
+
+    found, todo = set(), {}
+    for root, dirs, files in os.walk(os.path.abspath(directory)):
+        for i in files:
+            if not i.lower().endswith(".epub"):
+                continue
+            path = os.path.join(root, i)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            found.add(path)
+            # skip books unchanged since last scan, also those that failed
+            if known.get(path) != (st.st_size, st.st_mtime_ns):
+                todo[path] = st.st_size, st.st_mtime_ns
+
+    gone = [i for i in known if i.startswith(os.path.abspath(directory) + os.sep) and i not in found]
+    failed = n = 0
+    # warm only what fits below the 3/4 of DISKCACHESIZE pruning drops to,
+    # or the books warmed last would evict those warmed first; books are
+    # submitted a few at a time so the rest can be indexed without warming
+    budget = DISKCACHESIZE * 3 // 4 if warm and DISKCACHE else 0
+    warmed = cold = 0
+    workers = jobs or os.cpu_count() or 1
+    paths, pending = iter(todo), {}
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=prefetch_init,
+        initargs=(CACHEDIR, DISKCACHE)
+    ) as pool:
+
+        def submit():
+            nonlocal cold
+            for path in paths:
+                cold += warm and warmed >= budget
+                pending[pool.submit(index_worker, path, warmed < budget)] = path
+                return
+
+        for _ in range(workers):
+            submit()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for job in done:
+                path = pending.pop(job)
+                try:
+                    row, size = job.result()
+                    warmed += size
+                except Exception:
+                    # a row without contents, so it is retried only once the
+                    # file changes and loadcatalog() never uses it
+                    failed += 1
+                    row = (path,) + todo[path] + ("", "", None, None, None)
+                with STATEDB:
+                    STATEDB.execute("INSERT OR REPLACE INTO library VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row)
+                n += 1
+                sys.stderr.write("\r{}/{}".format(n, len(todo)))
+                submit()
+    with STATEDB:
+        STATEDB.executemany("DELETE FROM library WHERE filepath = ?", [(i,) for i in gone])
+    if todo:
+        sys.stderr.write("\n")
+    # unchanged books that failed before are still counted as failed
+    skipped = len((found & broken).difference(todo))
+    print("Indexed {} books: {} new or changed, {} unchanged, {} removed, {} failed".format(
+        len(found), len(todo) - failed, len(found) - len(todo), len(gone), failed + skipped
+    ))
+    if cold:
+        print("Warmed {} MB, the disk cache ({} MB) has no room for {} more books, "
+              "these were only indexed".format(warmed >> 20, DISKCACHESIZE >> 20, cold))
+
+
+def loadcatalog(ebook):
+    # fill contents and TOC from the --index catalog if the book is unchanged
+    if STATEDB is None:
+        return False
+    row = STATEDB.execute(
+        "SELECT size, mtime, contents, toc FROM library WHERE filepath = ?", (ebook.path,)
+    ).fetchone()
+    st = os.stat(ebook.path)
+    if row is None or row[:2] != (st.st_size, st.st_mtime_ns) or row[2] is None:
+        return False
+    ebook.contents = json.loads(row[2])
+    ebook.toc_entries = json.loads(row[3])
+    return True
+
+
+def savemeta(file, title, author):
+    STATE.setdefault(file, {}).update(title=title, author=author)
+    with STATEDB:
+        STATEDB.execute("INSERT OR IGNORE INTO reading_state (filepath) VALUES (?)", (file,))
+        STATEDB.execute(
+            "UPDATE reading_state SET title = ?, author = ? WHERE filepath = ?",
+            (title, author, file)
+        )
+        indexhistory(file, title, author)
+
+
+def delstate(files):
+    for i in files:
+        STATE.pop(i, None)
+    with STATEDB:
+        STATEDB.executemany("DELETE FROM reading_state WHERE filepath = ?", [(i,) for i in files])
+        for i in files:
+            unindexhistory(i)
+
+
+def trigrams(text):
+    grams = set()
+    for i in re.findall(r"\w+", text.lower()):
+        i = " " + i + " "
+        grams.update(i[j:j+3] for j in range(len(i) - 2))
+    return grams
+
+
+def indexhistory(file, title, author):
+    unindexhistory(file)
+    text = " ".join(i for i in (os.path.basename(file), title, author) if i)
+    grams = [(i, file) for i in trigrams(text)]
+    STATEDB.executemany("INSERT INTO history_trigram (gram, filepath) VALUES (?, ?)", grams)
+    STATEDB.executemany("INSERT OR IGNORE INTO history_gram (gram, n) VALUES (?, 0)", [i[:1] for i in grams])
+    STATEDB.executemany("UPDATE history_gram SET n = n + 1 WHERE gram = ?", [i[:1] for i in grams])
+
+
+def unindexhistory(file):
+    grams = STATEDB.execute("SELECT gram FROM history_trigram WHERE filepath = ?", (file,)).fetchall()
+    STATEDB.executemany("UPDATE history_gram SET n = n - 1 WHERE gram = ?", grams)
+    STATEDB.execute("DELETE FROM history_trigram WHERE filepath = ?", (file,))
+
+
+def searchhistory(query):
+    # candidates come from the rarest query trigrams (document frequencies
+    # are kept in history_gram) and are ranked by the share of query
+    # trigrams found in their basename, title and author, ties go to books
+    # added later
+    query = trigrams(query)
+    if query == set():
+        return []
+    freq = []
+    for i in range(0, len(query), 500):
+        chunk = list(query)[i:i+500]
+        freq += STATEDB.execute(
+            "SELECT gram, n FROM history_gram WHERE n > 0 AND gram IN ({})".format(",".join("?" * len(chunk))),
+            chunk
+        ).fetchall()
+    freq.sort(key=lambda x: x[1])
+    chosen, total = [], 0
+    for gram, n in freq:
+        if chosen != [] and total + n > 5000:
+            break
+        chosen.append(gram)
+        total += n
+    if chosen == []:
+        return []
+    # a query made only of very common trigrams doesn't tell books apart
+    # anyway, so don't rank more than a few thousand of them
+    cands = STATEDB.execute(
+        "SELECT DISTINCT filepath FROM history_trigram WHERE gram IN ({}) LIMIT 5000".format(
+            ",".join("?" * len(chosen))
+        ),
+        chosen
+    ).fetchall()
+
+    order = {j: n for n, j in enumerate(STATE)}
+    ranked = []
+    for (i,) in cands:
+        if i not in STATE:
+            continue
+        text = " ".join(j for j in (os.path.basename(i), STATE[i].get("title"), STATE[i].get("author")) if j)
+        ranked.append((len(query & trigrams(text)) / len(query), order[i], i))
+    ranked.sort(reverse=True)
+    return [(i[0], i[2]) for i in ranked]
 
 
 def pgup(pos, winhi, preservedline=0, c=1):
@@ -392,11 +2012,147 @@ def pgend(tot, winhi):
         return 0
 
 
+# only keeps the visible window plus a margin of wrapped lines in a small
+# pad instead of one full height pad per chapter, which is slow to fill on
+# huge chapters and breaks past the pad height limit of ncurses
+class Viewport:
+    def __init__(self, lines, width, rows, suff=""):
+        self.lines = lines
+        self.width = width
+        self.margin = rows
+        self.hi = rows + 2 * self.margin
+        self.suff = suff
+        self.top = None
+        # attributes set with chgat(), reapplied whenever lines are redrawn
+        self.attrs = {}
+        self.pad = curses.newpad(self.hi, width + 2) # + 2 unnecessary
+        # window painted over the pad on every refresh (book progress)
+        self.status = None
+
+    def __getattr__(self, name):
+        return getattr(self.pad, name)
+
+    def draw(self, top):
+        if TRACE is not None: t = time.perf_counter()
+        self.top = top
+        self.drawn = len(self.lines)
+        self.pad.erase()
+        for n in range(top, min(top + self.hi, len(self.lines))):
+            i = self.lines[n]
+            flag = self.lines.flags[n]
+            if flag & LINE_IMG:
+                self.pad.addstr(n - top, self.width//2 - len(i)//2, i, curses.A_REVERSE)
+            else:
+                self.pad.addstr(n - top, 0, i)
+            if flag & LINE_END and self.suff != "":
+                # try except to be more flexible on terminal resize
+                try:
+                    self.pad.addstr(n - top, self.width//2 - 7, self.suff, curses.A_REVERSE)
+                except curses.error:
+                    pass
+            for j, (l, attr) in self.attrs.get(n, {}).items():
+                self.pad.chgat(n - top, j, l, attr)
+        if TRACE is not None: trace_stage("draw", t)
+
+    def ensure(self, y, hi):
+        if self.top is None or y < self.top or y + hi > self.top + self.hi\
+           or self.drawn < min(len(self.lines), self.top + self.hi):
+            # last check: lines appended by ChapterStream since last draw
+            self.draw(max(0, y - self.margin))
+
+    def chgat(self, n, x, l, attr):
+        line = self.attrs.setdefault(n, {})
+        line.pop(x, None)
+        if attr in {curses.A_NORMAL, self.pad.getbkgd()}:
+            if line == {}:
+                del self.attrs[n]
+        else:
+            line[x] = l, attr
+        if self.top is not None and self.top <= n < self.top + self.hi:
+            self.pad.chgat(n - self.top, x, l, attr)
+
+    def noutrefresh(self, y, px, sminrow, smincol, smaxrow, smaxcol):
+        self.ensure(y, smaxrow - sminrow + 1)
+        self.pad.noutrefresh(y - self.top, px, sminrow, smincol, smaxrow, smaxcol)
+        if self.status is not None:
+            self.status.touchwin()
+            self.status.noutrefresh()
+
+    def refresh(self, y, px, sminrow, smincol, smaxrow, smaxcol):
+        # only cells that differ from the terminal are sent by doupdate()
+        self.noutrefresh(y, px, sminrow, smincol, smaxrow, smaxcol)
+        if TRACE is not None: t = time.perf_counter()
+        curses.doupdate()
+        if TRACE is not None: trace_stage("refresh", t)
+
+
+# the TOC pad is kept across opens of the same book; it holds only the
+# visible rows, entries are drawn when they scroll into view and moving
+# the selection redraws just the old and new row
+class TocView:
+    def __init__(self, src, wi, padhi):
+        self.src = src
+        self.wi = wi
+        self.padhi = padhi
+        self.low = None
+        self.query = ""
+        self.shown = list(range(len(src)))  # entries matching self.query
+        self.y = 0
+        self.sel = None
+        self.pad = curses.newpad(padhi, wi - 2)
+        self.pad.keypad(True)
+
+    def row(self, n):
+        strs = (">>" if n == self.sel else "  ") + self.src[self.shown[n]]
+        strs = strs[0:self.wi-3]
+        self.pad.move(n - self.y, 0)
+        self.pad.clrtoeol()
+        self.pad.addstr(n - self.y, 0, strs, curses.A_REVERSE if n == self.sel else curses.A_NORMAL)
+
+    def draw(self, y):
+        self.y = y
+        self.pad.erase()
+        for n in range(y, min(y + self.padhi, len(self.shown))):
+            self.row(n)
+
+    def select(self, sel):
+        old, self.sel = self.sel, sel
+        if sel is not None and sel < self.y:
+            self.draw(sel)
+        elif sel is not None and sel >= self.y + self.padhi:
+            self.draw(sel - self.padhi + 1)
+        else:
+            for n in {old, sel} - {None}:
+                if self.y <= n < min(self.y + self.padhi, len(self.shown)):
+                    self.row(n)
+
+    def locate(self, index):
+        # row of entry index, or of the entry before it if filtered out
+        if not self.shown:
+            return None
+        return max(0, bisect_right(self.shown, index) - 1)
+
+    def filter(self, query):
+        if self.low is None:
+            self.low = [i.lower() for i in self.src]
+        q = query.lower()
+        # a longer query only needs to look at what the shorter one matched
+        if q.startswith(self.query.lower()):
+            base = self.shown
+        else:
+            base = range(len(self.src))
+        self.shown = [n for n in base if q in self.low[n]]
+        self.query = query
+
+
+TOCVIEW = None
+
+
 def toc(stdscr, src, index):
+    global TOCVIEW
     rows, cols = stdscr.getmaxyx()
     hi, wi = rows - 4, cols - 4
     Y, X = 2, 2
-    oldindex = index
     toc = curses.newwin(hi, wi, Y, X)
     if COLORSUPPORT:
         toc.bkgd(stdscr.getbkgd())
@@ -407,30 +2163,34 @@ def toc(stdscr, src, index):
     toc.addstr(2,2, "-----------------")
     key_toc = 0
 
-    totlines = len(src)
-    toc.refresh()
-    pad = curses.newpad(totlines, wi - 2 )
+    padhi = rows - 5 - Y - 4 + 1
+    if TOCVIEW is None or TOCVIEW.src is not src or (TOCVIEW.wi, TOCVIEW.padhi) != (wi, padhi):
+        TOCVIEW = TocView(src, wi, padhi)
+    view = TOCVIEW
+    pad = view.pad
     if COLORSUPPORT:
         pad.bkgd(stdscr.getbkgd())
 
-    pad.keypad(True)
+    def prompt(typing=False):
+        # only this row is touched, refreshing toc must not cover the pad
+        toc.addstr(hi - 2, 1, " " * (wi - 2))
+        if typing or view.query != "":
+            line = "/" + view.query
+            toc.addstr(hi - 2, wi - 4 - len(str(len(view.shown))), str(len(view.shown)))
+            toc.addstr(hi - 2, 2, line[-(wi - 12):])
+        toc.refresh()
 
-    padhi = rows - 5 - Y - 4 + 1
+    index = view.locate(index)
     y = 0
-    if index in range(padhi//2, totlines - padhi//2):
+    if index is not None and index in range(padhi//2, len(view.shown) - padhi//2):
         y = index - padhi//2 + 1
-    d = len(str(totlines))
-    span = []
-
-    for n, i in enumerate(src):
-        # strs = "  " + str(n+1).rjust(d) + " " + i[0]
-        strs = "  " + i
-        strs = strs[0:wi-3]
-        pad.addstr(n, 0, strs)
-        span.append(len(strs))
+    view.sel = index
+    view.draw(y)
+    prompt()
 
     countstring = ""
     while key_toc not in TOC|QUIT:
+        totlines = len(view.shown)
         if countstring == "":
             count = 1
         else:
@@ -438,7 +2198,11 @@ def toc(stdscr, src, index):
         if key_toc in range(48, 58): # i.e., k is a numeral
             countstring = countstring + chr(key_toc)
         else:
-            if key_toc in SCROLL_UP|SCROLL_UP_K or key_toc in PAGE_UP:
+            if key_toc in {curses.KEY_RESIZE}|HELP|META:
+                return key_toc
+            elif totlines == 0:
+                pass
+            elif key_toc in SCROLL_UP|SCROLL_UP_K or key_toc in PAGE_UP:
                 index -= count
                 if index < 0:
                     index = 0
@@ -449,39 +2213,52 @@ def toc(stdscr, src, index):
             elif key_toc in FOLLOW:
                 # if index == oldindex:
                 #     break
-                return index
-            # elif key_toc in PAGE_UP:
-            #     index -= 3
-            #     if index < 0:
-            #         index = 0
-            # elif key_toc in PAGE_DOWN:
-            #     index += 3
-            #     if index >= totlines:
-            #         index = totlines - 1
+                return view.shown[index]
             elif key_toc in CH_HOME:
                 index = 0
             elif key_toc in CH_END:
                 index = totlines - 1
-            elif key_toc in {curses.KEY_RESIZE}|HELP|META:
-                return key_toc
+            if key_toc == ord("/"):
+                # filter as you type, Enter keeps the filter, Esc drops it
+                entry = None if index is None else view.shown[index]
+                curses.curs_set(1)
+                prompt(True)
+                while True:
+                    ipt = getkey(toc, wide=True)
+                    if type(ipt) == str:
+                        ipt = ord(ipt)
+                    if ipt == 10:
+                        break
+                    elif ipt == 27:
+                        query = ""
+                    elif ipt in {8, 127, curses.KEY_BACKSPACE}:
+                        query = view.query[:-1]
+                    elif ipt == curses.KEY_RESIZE:
+                        curses.curs_set(0)
+                        return ipt
+                    elif ipt >= 32 and ipt < 0x110000 and chr(ipt).isprintable():
+                        query = view.query + chr(ipt)
+                    else:
+                        continue
+                    view.filter(query)
+                    index = None if entry is None else view.locate(entry)
+                    if index is None and view.shown:
+                        index = 0
+                    view.sel = index
+                    view.draw(0 if index is None else max(0, index - padhi + 1))
+                    pad.noutrefresh(0, 0, Y+4,X+4, rows - 5, cols - 6)
+                    prompt(ipt != 27)
+                    if ipt == 27:
+                        break
+                curses.curs_set(0)
+                prompt()
             countstring = ""
 
-        while index not in range(y, y+padhi):
-            if index < y:
-                y -= 1
-            else:
-                y += 1
-
-        for n in range(totlines):
-            att = curses.A_REVERSE if index == n else curses.A_NORMAL
-            pre = ">>" if index == n else "  "
-            pad.addstr(n, 0, pre)
-            pad.chgat(n, 0, span[n], pad.getbkgd() | att)
+        view.select(index)
+        pad.refresh(0, 0, Y+4,X+4, rows - 5, cols - 6)
+        key_toc = getkey(toc)
 
-        pad.refresh(y, 0, Y+4,X+4, rows - 5, cols - 6)
-        key_toc = toc.getch()
-
-    toc.clear()
+    toc.erase()
     toc.refresh()
     return
 
@@ -500,6 +2277,7 @@ def meta(stdscr, ebook):
     meta.addstr(2,2, "--------")
     key_meta = 0
 
+    import textwrap
     mdata = []
     for i in ebook.get_meta():
         data = re.sub("<[^>]*>", "", i[1])
@@ -537,7 +2315,7 @@ def meta(stdscr, ebook):
         elif key_meta in {curses.KEY_RESIZE}|HELP|TOC:
             return key_meta
         pad.refresh(y,0, 6,5, rows - 5, cols - 5)
-        key_meta = meta.getch()
+        key_meta = getkey(meta)
 
     meta.clear()
     meta.refresh()
@@ -591,7 +2369,7 @@ def help(stdscr):
         elif key_help in {curses.KEY_RESIZE}|META|TOC:
             return key_help
         pad.refresh(y,0, 6,5, rows - 5, cols - 5)
-        key_help = help.getch()
+        key_help = getkey(help)
 
     help.clear()
     help.refresh()
@@ -612,8 +2390,12 @@ def dots_path(curr, tofi):
     return "/".join(candir+tofi)
 
 
+# looked up when "o" is first pressed rather than on every launch
 def find_media_viewer():
     global VWR
+    if VWR is not None:
+        return VWR
+    VWR = []
     VWR_LIST = [
         "feh",
         "gio",
@@ -634,30 +2416,69 @@ def find_media_viewer():
                 VWR = [i]
                 break
 
-    if VWR[0] in {"gio"}:
+    if VWR[:1] == ["gio"]:
         VWR.append("open")
+    return VWR
 
 
-def open_media(scr, epub, src):
-    sfx = os.path.splitext(src)[1]
-    fd, path = tempfile.mkstemp(suffix=sfx)
-    try:
-        with os.fdopen(fd, "wb") as tmp:
-            tmp.write(epub.file.read(src))
-        # run(VWR +" "+ path, shell=True)
-        subprocess.call(
-            VWR + [path],
-            # shell=True,
+# images extracted this session, one temp file per (book, zip path), in a
+# directory removed at exit; images on screen are extracted ahead of 'o'
+# by a worker thread so the viewer starts right away
+class MediaCache:
+    def __init__(self):
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+        self.dir = tempfile.mkdtemp(prefix="epr-")
+        self.files = {}
+        self.procs = []
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        atexit.register(self.cleanup)
+
+    def extract(self, epub, src):
+        key = (epub.path, src)
+        if key not in self.files:
+            self.files[key] = self.pool.submit(self.write, epub, src, len(self.files))
+        return self.files[key]
+
+    def write(self, epub, src, n):
+        path = os.path.join(self.dir, str(n) + os.path.splitext(src)[1])
+        with open(path, "wb") as f:
+            f.write(epub.file.read(src))
+        return path
+
+    def open(self, epub, src):
+        import subprocess
+        # reap viewers that were closed meanwhile
+        self.procs = [i for i in self.procs if i.poll() is None]
+        self.procs.append(subprocess.Popen(
+            VWR + [self.extract(epub, src).result()],
+            stdin=subprocess.DEVNULL,
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL
-        )
-        k = scr.getch()
-    finally:
-        os.remove(path)
-    return k
+        ))
+
+    def cleanup(self):
+        self.pool.shutdown(wait=True)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
 
+def open_media(epub, src):
+    global MEDIA
+    if MEDIA is None:
+        MEDIA = MediaCache()
+    MEDIA.open(epub, src)
 
-def searching(stdscr, pad, src, width, y, ch, tot):
+
+def premedia(epub, chpath, lines, imgs, y, rows):
+    global MEDIA
+    for n in range(y, min(y + rows, len(lines))):
+        if lines.flags[n] & LINE_IMG and lines.imgno(n) < len(imgs):
+            if MEDIA is None:
+                MEDIA = MediaCache()
+            MEDIA.extract(epub, dots_path(chpath, imgs[lines.imgno(n)]))
+
+
+def searching(stdscr, pad, ebook, src, starts, width, y, ch, tot):
     global SEARCHPATTERN
     rows, cols = stdscr.getmaxyx()
     x = (cols - width) // 2
@@ -674,12 +2495,12 @@ def searching(stdscr, pad, src, width, y, ch, tot):
         stat.addstr(0, 7, SEARCHPATTERN)
         stat.refresh()
         while True:
-            ipt = stat.get_wch()
+            ipt = getkey(stat, wide=True)
             if type(ipt) == str:
                 ipt = ord(ipt)
 
             if ipt == 27:
-                stat.clear()
+                stat.erase()
                 stat.refresh()
                 curses.echo(0)
                 curses.curs_set(0)
@@ -687,7 +2508,7 @@ def searching(stdscr, pad, src, width, y, ch, tot):
                 return None, y
             elif ipt == 10:
                 SEARCHPATTERN = "/"+SEARCHPATTERN
-                stat.clear()
+                stat.erase()
                 stat.refresh()
                 curses.echo(0)
                 curses.curs_set(0)
@@ -696,7 +2517,7 @@ def searching(stdscr, pad, src, width, y, ch, tot):
             elif ipt in {8, 127, curses.KEY_BACKSPACE}:
                 SEARCHPATTERN = SEARCHPATTERN[:-1]
             elif ipt == curses.KEY_RESIZE:
-                stat.clear()
+                stat.erase()
                 stat.refresh()
                 curses.echo(0)
                 curses.curs_set(0)
@@ -705,7 +2526,7 @@ def searching(stdscr, pad, src, width, y, ch, tot):
             else:
                 SEARCHPATTERN += chr(ipt)
 
-            stat.clear()
+            stat.erase()
             stat.addstr(0, 0, " Regex:", curses.A_REVERSE)
             # stat.addstr(0, 7, SEARCHPATTERN)
             stat.addstr(
@@ -718,124 +2539,178 @@ def searching(stdscr, pad, src, width, y, ch, tot):
         SEARCHPATTERN = None
         return None, y
 
-    found = []
     try:
-        pattern = re.compile(SEARCHPATTERN[1:], re.IGNORECASE)
+        # paragraphs are searched joined by newlines, MULTILINE keeps ^ and
+        # $ anchored at each of them rather than at the chapter's ends
+        pattern = re.compile(SEARCHPATTERN[1:], re.IGNORECASE | re.MULTILINE)
     except re.error:
         stdscr.addstr(rows-1, 0, "Invalid Regex!", curses.A_REVERSE)
         SEARCHPATTERN = None
-        s = stdscr.getch()
+        s = getkey(stdscr)
         if s in QUIT:
             return None, y
         else:
             return s, None
 
-    for n, i in enumerate(src):
-        for j in pattern.finditer(i):
-            found.append([n, j.span()[0], j.span()[1] - j.span()[0]])
+    key = (ebook.path, SEARCHPATTERN[1:])
+    book = SEARCHCACHE.get(key)
+    if book is None:
+        book = BookSearch(ebook, pattern, ch)
+        SEARCHCACHE[key] = book
+        if len(SEARCHCACHE) > SEARCHCACHESIZE:
+            old, oldbook = SEARCHCACHE.popitem(last=False)
+            oldbook.cancel()
+            IDLETASKS.pop(old, None)
+    else:
+        SEARCHCACHE.move_to_end(key)
+    if not book.done and key not in IDLETASKS:
+        idle(key, book.polling())
+
+    def paint(msg, s):
+        if TRACE is not None: trace_frame(s)
+        stdscr.erase()
+        stdscr.addstr(rows-1, 0, msg[:cols-1], curses.A_REVERSE)
+        stdscr.noutrefresh()
+        pad.refresh(y,0, 0,x, rows-2,x+width)
+        if TRACE is not None: trace_painted()
+
+    def wait(ready):
+        # until the worker got far enough, False if Esc cancelled the search
+        s, shown = 0, None
+        while not ready():
+            if s in QUIT:
+                book.cancel()
+                SEARCHCACHE.pop(key, None)
+                IDLETASKS.pop(key, None)
+                return False
+            if shown != book.hits:
+                shown = book.hits
+                paint(" Searching: {} --- {}+ hits, Esc to cancel ".format(SEARCHPATTERN[1:], shown), s)
+            s = getkey(pad, until=lambda: ready() or book.hits != shown)
+        return True
+
+    def nextch(step):
+        if not wait(lambda: book.find(ch, step) is not False):
+            return None
+        nxt = book.find(ch, step)
+        return None if nxt is None else nxt - ch
+
+    if not wait(lambda: book.spans[ch] is not None):
+        SEARCHPATTERN = None
+        return None, y
+    found = locate_matches(load_parsed(ebook, ch), src, starts, book.spans[ch])
 
     if found == []:
-        if SEARCHPATTERN[0] == "/" and ch + 1 < tot:
-            return None, 1
-        elif SEARCHPATTERN[0] == "?" and ch > 0:
-            return None, -1
+        step = nextch(1 if SEARCHPATTERN[0] == "/" else -1)
+        if step is not None:
+            return None, step
         else:
             s = 0
             while True:
                 if s in QUIT:
                     SEARCHPATTERN = None
-                    stdscr.clear()
-                    stdscr.refresh()
                     return None, y
-                elif s == ord("n") and ch == 0:
+                elif s == ord("n") and nextch(1) is not None:
                     SEARCHPATTERN = "/"+SEARCHPATTERN[1:]
-                    return None, 1
-                elif s == ord("N") and ch +1 == tot:
+                    return None, nextch(1)
+                elif s == ord("N") and nextch(-1) is not None:
                     SEARCHPATTERN = "?"+SEARCHPATTERN[1:]
-                    return None, -1
+                    return None, nextch(-1)
 
-                stdscr.clear()
-                stdscr.addstr(rows-1, 0, " Finished searching: " + SEARCHPATTERN[1:cols-22] + " ", curses.A_REVERSE)
-                stdscr.refresh()
-                pad.refresh(y,0, 0,x, rows-2,x+width)
-                s = pad.getch()
+                paint(" Finished searching: " + SEARCHPATTERN[1:cols-22] + " ", s)
+                s = getkey(pad)
 
     sidx = len(found) - 1
     if SEARCHPATTERN[0] == "/":
-        if y > found[-1][0]:
-            return None, 1
+        if y > found[-1][0][0]:
+            step = nextch(1)
+            if step is not None:
+                return None, step
         for n, i in enumerate(found):
-            if i[0] >= y:
+            if i[0][0] >= y:
                 sidx = n
                 break
 
+    # only the current match is highlighted, so moving to another one
+    # touches just the old and the new match; Viewport keeps the attribute
+    # and applies it whenever the line gets drawn
+    def highlight(n, attr):
+        for j in found[n]:
+            pad.chgat(j[0], j[1], j[2], attr)
+
+    shown = None
     s = 0
-    msg = " Searching: " + SEARCHPATTERN[1:] + " --- Res {}/{} Ch {}/{} ".format(
-        sidx + 1,
-        len(found),
-        ch+1, tot)
+    finished = False
     while True:
         if s in QUIT:
             SEARCHPATTERN = None
-            for i in found:
-                pad.chgat(i[0], i[1], i[2], pad.getbkgd())
-            stdscr.clear()
-            stdscr.refresh()
+            if shown is not None:
+                highlight(shown, pad.getbkgd())
+            # Esc also stops a search still running in the background
+            if s == 27 and not book.done:
+                book.cancel()
+                SEARCHCACHE.pop(key, None)
+                IDLETASKS.pop(key, None)
             return None, y
         elif s == ord("n"):
             SEARCHPATTERN = "/"+SEARCHPATTERN[1:]
             if sidx == len(found) - 1:
-                if ch + 1 < tot:
-                    return None, 1
+                step = nextch(1)
+                if step is not None:
+                    return None, step
                 else:
                     s = 0
-                    msg = " Finished searching: " + SEARCHPATTERN[1:] + " "
+                    finished = True
                     continue
             else:
                 sidx += 1
-                msg = " Searching: " + SEARCHPATTERN[1:] + " --- Res {}/{} Ch {}/{} ".format(
-                    sidx + 1,
-                    len(found),
-                    ch+1, tot)
+                finished = False
         elif s == ord("N"):
             SEARCHPATTERN = "?"+SEARCHPATTERN[1:]
             if sidx == 0:
-                if ch > 0:
-                    return None, -1
+                step = nextch(-1)
+                if step is not None:
+                    return None, step
                 else:
                     s = 0
-                    msg = " Finished searching: " + SEARCHPATTERN[1:] + " "
+                    finished = True
                     continue
             else:
                 sidx -= 1
-                msg = " Searching: " + SEARCHPATTERN[1:] + " --- Res {}/{} Ch {}/{} ".format(
-                    sidx + 1,
-                    len(found),
-                    ch+1, tot)
+                finished = False
         elif s == curses.KEY_RESIZE:
             return s, None
 
-        while found[sidx][0] not in list(range(y, y+rows-1)):
-            if found[sidx][0] > y:
+        while not y <= found[sidx][0][0] < y+rows-1:
+            if found[sidx][0][0] > y:
                 y += rows - 1
             else:
                 y -= rows - 1
                 if y < 0:
                     y = 0
 
-        for n, i in enumerate(found):
-            # attr = (pad.getbkgd() | curses.A_REVERSE) if n == sidx else pad.getbkgd()
-            attr = curses.A_REVERSE if n == sidx else curses.A_NORMAL
-            pad.chgat(i[0], i[1], i[2], pad.getbkgd() | attr)
-
-        stdscr.clear()
-        stdscr.addstr(rows-1, 0, msg, curses.A_REVERSE)
-        stdscr.refresh()
-        pad.refresh(y,0, 0,x, rows-2,x+width)
-        s = pad.getch()
+        if shown != sidx:
+            if shown is not None:
+                highlight(shown, pad.getbkgd())
+            highlight(sidx, pad.getbkgd() | curses.A_REVERSE)
+            shown = sidx
+
+        # the counts keep growing while the worker goes through the book
+        state = book.hits, book.done
+        before = book.before(ch)
+        if finished:
+            paint(" Finished searching: " + SEARCHPATTERN[1:] + " ", s)
+        else:
+            paint(" Searching: {} --- hit {} of {}{} Ch {}/{} ".format(
+                SEARCHPATTERN[1:],
+                "?" if before is None else before + sidx + 1,
+                book.hits, "" if book.done else "+",
+                ch+1, tot), s)
+        s = getkey(pad, until=lambda: (book.hits, book.done) != state)
 
 
 def reader(stdscr, ebook, index, width, y, pctg):
+    global LINEINDEX
     k = 0 if SEARCHPATTERN is None else ord("/")
     rows, cols = stdscr.getmaxyx()
     x = (cols - width) // 2
@@ -843,56 +2718,104 @@ def reader(stdscr, ebook, index, width, y, pctg):
     contents = ebook.contents
     toc_src = ebook.toc_entries
     chpath = contents[index]
-    content = ebook.file.open(chpath).read()
-    content = content.decode("utf-8")
-
-    parser = HTMLtoLines()
-    try:
-        parser.feed(content)
-        parser.close()
-    except:
-        pass
-
-    src_lines, imgs = parser.get_lines(width)
+    if TRACE is not None:
+        trace_begin(index)
+        t = time.perf_counter()
+    # landing at a percentage or at the end needs the full line count,
+    # otherwise a big chapter is streamed rather than waited for
+    big = pctg is None and y >= 0 and ChapterStream.wanted(ebook, index, width)
+    PREFETCHER.take((ebook.path, index, width), wait=not big)
+    if TRACE is not None: trace_stage("prefetch_wait", t)
+    stream = None
+    if big and ChapterStream.wanted(ebook, index, width):
+        stream = ChapterStream(ebook, index, width)
+        if TRACE is not None: t = time.perf_counter()
+        stream.fill(y + rows)
+        if TRACE is not None: trace_stage("stream", t, "stream")
+        src_lines, imgs, starts = stream.lines, stream.imgs, stream.starts
+    else:
+        src_lines, imgs, starts = load_chapter(ebook, index, width)
     totlines = len(src_lines)
 
     if y < 0 and totlines <= rows:
         y = 0
     elif pctg is not None:
         y = round(pctg*totlines)
-    else:
+    elif y < 0 and (stream is None or stream.done):
         y = y % totlines
+    else:
+        y = min(y, totlines - 1)
 
-    pad = curses.newpad(totlines, width + 2) # + 2 unnecessary
-
-    if COLORSUPPORT:
-        pad.bkgd(stdscr.getbkgd())
+    if LINEINDEX is None or (LINEINDEX.path, LINEINDEX.width) != (ebook.path, width):
+        LINEINDEX = LineIndex(ebook, width)
+    if stream is None or stream.done:
+        LINEINDEX.counts[index] = totlines
+        LINEINDEX.streaming = None
+    else:
+        LINEINDEX.streaming = index
 
-    pad.keypad(True)
-    for n, i in enumerate(src_lines):
-        if re.search("\[IMG:[0-9]+\]", i):
-            pad.addstr(n, width//2 - len(i)//2, i, curses.A_REVERSE)
-        else:
-            pad.addstr(n, 0, i)
     if index == 0:
         suff = "     End --> "
     elif index == len(contents) - 1:
         suff = " <-- End     "
     else:
         suff = " <-- End --> "
-    # try except to be more flexible on terminal resize
-    try:
-        pad.addstr(n, width//2 - 7, suff, curses.A_REVERSE)
-    except curses.error:
-        pass
+    pad = Viewport(src_lines, width, rows, suff)
 
-    stdscr.clear()
-    stdscr.refresh()
+    if COLORSUPPORT:
+        pad.bkgd(stdscr.getbkgd())
+
+    pad.keypad(True)
+
+    # book progress in the bottom right corner, only if it fits in the
+    # margin right of the pad (columns x to x+width)
+    if cols - 6 > x + width:
+        pad.status = curses.newwin(1, 6, rows - 1, cols - 6)
+        if COLORSUPPORT:
+            pad.status.bkgd(stdscr.getbkgd())
+
+    def progress():
+        if pad.status is not None:
+            pad.status.erase()
+            if stream is None or stream.done:
+                pad.status.addstr(0, 0, LINEINDEX.progress(index, y, rows).rjust(5))
+    progress()
+
+    if TRACE is not None: trace_frame("open")
+    stdscr.erase()
+    stdscr.noutrefresh()
     # try except to be more flexible on terminal resize
     try:
         pad.refresh(y,0, 0,x, rows-1,x+width)
     except curses.error:
         pass
+    if TRACE is not None:
+        trace_painted()
+        trace_end(totlines)
+
+    PREFETCHER.schedule(ebook, index, width)
+    PREFETCHER.count(LINEINDEX)
+
+    if stream is not None and not stream.done:
+        def streaming():
+            # parse the rest of the chapter while no key is pressed
+            while not stream.done:
+                stream.step()
+                yield
+            # finished before the next key, show the end of chapter mark
+            pad.top = None
+            LINEINDEX.counts[index] = len(src_lines)
+            progress()
+            try:
+                pad.refresh(y,0, 0,x, min(len(src_lines)-y, rows-1),x+width)
+            except curses.error:
+                pass
+            # saving waits for the line count, nothing else schedules it
+            # until the next key
+            idle("save", saving(ebook.path, index, width, y, y/len(src_lines)))
+        idle("stream", streaming())
+    else:
+        IDLETASKS.pop("stream", None)
 
     countstring = ""
     svline = "dontsave"
@@ -901,6 +2824,19 @@ def reader(stdscr, ebook, index, width, y, pctg):
             count = 1
         else:
             count = int(countstring)
+        if stream is not None and not stream.done:
+            # scrolling only needs enough lines ahead, keys that go to the
+            # end or keep y/totlines (G, %, width, search, quit, ...) need
+            # the whole chapter, the rest is left to the idle task
+            if k in SCROLL_DOWN|SCROLL_DOWN_J|PAGE_DOWN|HALF_DOWN:
+                stream.fill(y + (count + 2) * rows)
+            elif k in CH_END|QUIT|{JUMPTOPCTG, WIDEN, SHRINK, WIDTH, MARKPOS, ord("/"), curses.KEY_RESIZE}:
+                stream.finish()
+            if stream.done:
+                IDLETASKS.pop("stream", None)
+                pad.top = None
+                LINEINDEX.counts[index] = len(src_lines)
+            totlines = len(src_lines)
         if k in range(48, 58): # i.e., k is a numeral
             countstring = countstring + chr(k)
         else:
@@ -977,6 +2913,8 @@ def reader(stdscr, ebook, index, width, y, pctg):
                     if fllwd in {curses.KEY_RESIZE}|HELP|META:
                         k = fllwd
                         continue
+                    if fllwd not in {index - 1, index + 1}:
+                        PREFETCHER.cancel()
                     return fllwd - index, width, 0, None
             elif k in META:
                 k = meta(stdscr, ebook)
@@ -1014,7 +2952,7 @@ def reader(stdscr, ebook, index, width, y, pctg):
             #     else:
             #         return 0, cols - 2, 0, y/totlines
             elif k == ord("/"):
-                ks, idxs = searching(stdscr, pad, src_lines, width, y, index, len(contents))
+                ks, idxs = searching(stdscr, pad, ebook, src_lines, starts, width, y, index, len(contents))
                 if ks in {curses.KEY_RESIZE, ord("/")}:
                     k = ks
                     continue
@@ -1022,13 +2960,12 @@ def reader(stdscr, ebook, index, width, y, pctg):
                     return idxs, width, 0, None
                 elif idxs is not None:
                     y = idxs
-            elif k == ord("o") and VWR is not None:
+            elif k == ord("o") and find_media_viewer():
                 gambar, idx = [], []
-                for n, i in enumerate(src_lines[y:y+rows]):
-                    img = re.search("(?<=\[IMG:)[0-9]+(?=\])", i)
-                    if img is not None:
-                        gambar.append(img.group())
-                        idx.append(n)
+                for n in range(y, min(y+rows, totlines)):
+                    if src_lines.flags[n] & LINE_IMG:
+                        gambar.append(str(src_lines.imgno(n)))
+                        idx.append(n - y)
 
                 impath = ""
                 if len(gambar) == 1:
@@ -1039,7 +2976,7 @@ def reader(stdscr, ebook, index, width, y, pctg):
                         stdscr.move(idx[i], x + width//2 + len(gambar[i]) + 1)
                         stdscr.refresh()
                         curses.curs_set(1)
-                        p = pad.getch()
+                        p = getkey(pad)
                         if p in SCROLL_DOWN:
                             i += 1
                         elif p in SCROLL_UP:
@@ -1051,18 +2988,25 @@ def reader(stdscr, ebook, index, width, y, pctg):
                         impath = imgs[int(gambar[i])]
 
                 if impath != "":
-                    imgsrc = dots_path(chpath, impath)
-                    k = open_media(pad, ebook, imgsrc)
-                    continue
+                    open_media(ebook, dots_path(chpath, impath))
             elif k == MARKPOS:
-                jumnum = pad.getch()
+                jumnum = getkey(pad)
                 if jumnum in range(49, 58):
                     JUMPLIST[chr(jumnum)] = [index, width, y, y/totlines]
                 else:
                     k = jumnum
                     continue
+            elif k == JUMPTOPCTG and countstring != "":
+                if LINEINDEX.missing() is not None:
+                    stdscr.addstr(rows-1, 0, "Indexing...")
+                    stdscr.refresh()
+                    LINEINDEX.complete(ebook)
+                n, tojumpy = LINEINDEX.locate(round(min(count, 100) * sum(LINEINDEX.counts) / 100), rows)
+                if n != index:
+                    return n - index, width, tojumpy, None
+                y = tojumpy
             elif k == JUMPTOPOS:
-                jumnum = pad.getch()
+                jumnum = getkey(pad)
                 if jumnum in range(49, 58) and chr(jumnum) in JUMPLIST.keys():
                     tojumpidxdiff = JUMPLIST[chr(jumnum)][0]-index
                     tojumpy = JUMPLIST[chr(jumnum)][2]
@@ -1092,6 +3036,8 @@ def reader(stdscr, ebook, index, width, y, pctg):
                     curses.resize_term(rows, cols)
                 if cols < 22 or rows < 12:
                     sys.exit("ERR: Screen was too small (min 22cols x 12rows).")
+                # what is on the terminal is unknown now, repaint it all
+                stdscr.clear()
                 if cols <= width + 4:
                     return 0, cols - 4, 0, y/totlines
                 else:
@@ -1100,17 +3046,32 @@ def reader(stdscr, ebook, index, width, y, pctg):
 
         if svline != "dontsave":
             pad.chgat(svline, 0, width, curses.A_UNDERLINE)
+        progress()
+        if TRACE is not None: trace_frame(k)
         try:
-            stdscr.clear()
+            # no clear(): it makes curses repaint the whole terminal, erase()
+            # and doupdate() only send the cells that changed, and lines
+            # moved by a scroll are shifted by the terminal (see idlok)
+            stdscr.erase()
             stdscr.addstr(0, 0, countstring)
-            stdscr.refresh()
+            stdscr.noutrefresh()
             if totlines - y < rows:
                 pad.refresh(y,0, 0,x, totlines-y,x+width)
             else:
                 pad.refresh(y,0, 0,x, rows-1,x+width)
         except curses.error:
             pass
-        k = pad.getch()
+        if TRACE is not None: trace_painted()
+        # only once "o" found a viewer, so reading never scans PATH for one
+        # and nothing is extracted for readers who don't open images
+        if imgs and VWR:
+            premedia(ebook, chpath, src_lines, imgs, y, rows)
+        if stream is None or stream.done:
+            idle("save", saving(ebook.path, index, width, y, y/totlines))
+        if PREFETCHER.jobs:
+            idle("harvest", harvesting())
+        k = getkey(pad)
+        totlines = len(src_lines)
 
         if svline != "dontsave":
             pad.chgat(svline, 0, width, curses.A_NORMAL)
@@ -1119,7 +3080,6 @@ def reader(stdscr, ebook, index, width, y, pctg):
 
 def preread(stdscr, file):
     global COLORSUPPORT
-
     curses.use_default_colors()
     try:
         curses.init_pair(1, -1, -1)
@@ -1130,6 +3090,8 @@ def preread(stdscr, file):
         COLORSUPPORT  = False
 
     stdscr.keypad(True)
+    # let doupdate() scroll the terminal instead of repainting moved lines
+    stdscr.idlok(True)
     curses.curs_set(0)
     stdscr.clear()
     rows, cols = stdscr.getmaxyx()
@@ -1155,8 +3117,13 @@ def preread(stdscr, file):
         if "pctg" in STATE[epub.path]:
             pctg = float(STATE[epub.path]["pctg"])
 
-    epub.initialize()
-    find_media_viewer()
+    # for matching "epr STRINGS" against title and author
+    if STATE[epub.path].get("title") is None:
+        meta = dict(epub.get_meta())
+        savemeta(epub.path, meta.get("title", ""), meta.get("creator", ""))
+
+    if not loadcatalog(epub):
+        epub.initialize()
 
     while True:
         incr, width, y, pctg = reader(stdscr, epub, idx, width, y, pctg)
@@ -1164,6 +3131,7 @@ def preread(stdscr, file):
 
 
 def main():
+    global DISKCACHE, TRACE
     termc, termr = shutil.get_terminal_size()
 
     args = []
@@ -1190,18 +3158,73 @@ def main():
     else:
         dump = False
 
+    if "--trace-summary" in args:
+        try:
+            trace_summary(args[args.index("--trace-summary") + 1])
+        except (IndexError, OSError) as e:
+            sys.exit("ERROR: Cannot read trace file: " + str(e))
+        sys.exit()
+
+    for i in [j for j in args if j.startswith("--trace=")]:
+        args.remove(i)
+        os.environ["EPR_TRACE"] = i.split("=", 1)[1]
+    if os.getenv("EPR_TRACE"):
+        TRACE = open(os.getenv("EPR_TRACE"), "a")
+
+    loadcache()
+    if len({"--clear-cache"} & set(args)) != 0:
+        clearcache()
+        sys.exit()
+
+    if len({"--no-cache"} & set(args)) != 0:
+        args.remove("--no-cache")
+        DISKCACHE = False
+
+    for i in [j for j in args if j.startswith("--prefetch=")]:
+        args.remove(i)
+        PREFETCHER.mode = i.split("=", 1)[1]
+        if PREFETCHER.mode not in {"thread", "process", "off"}:
+            sys.exit("ERROR: Unknown prefetch mode: " + PREFETCHER.mode)
+
+    dumpopts = {}
+    for i in [j for j in args if re.match("--(width|outdir|jobs)=", j)]:
+        args.remove(i)
+        opt, val = i[2:].split("=", 1)
+        if opt in {"width", "jobs"}:
+            try:
+                val = int(val)
+            except ValueError:
+                sys.exit("ERROR: --{} needs a number.".format(opt))
+        dumpopts[opt] = val
+    if not dump and ("width" in dumpopts or "outdir" in dumpopts):
+        sys.exit("ERROR: --width and --outdir need -d.")
+    if not dump and "jobs" in dumpopts and "--index" not in args:
+        sys.exit("ERROR: --jobs needs -d or --index.")
+    if dump:
+        # a one-off dump shouldn't fill the cache with the whole book
+        DISKCACHE = False
+
     loadstate()
 
+    if "--index" in args:
+        try:
+            directory = args[args.index("--index") + 1]
+        except IndexError:
+            sys.exit("ERROR: --index needs a directory.")
+        if not os.path.isdir(directory):
+            sys.exit("ERROR: Not a directory: " + directory)
+        index_library(directory, "--warm" in args, dumpopts.get("jobs"))
+        sys.exit()
+
     if args == []:
-        file, todel = False, []
+        file = False
         for i in STATE:
-            if not os.path.exists(i):
-                todel.append(i)
-            elif STATE[i]["lastread"] == str(1):
+            if STATE[i]["lastread"] == str(1):
                 file = i
-
-        for i in todel:
-            del STATE[i]
+        # only the book about to be opened is checked for existence
+        if file and not os.path.exists(file):
+            delstate([file])
+            file = False
 
         if not file:
             print(__doc__)
@@ -1212,25 +3235,24 @@ def main():
 
     else:
         val = cand = 0
-        todel = []
-        for i in STATE.keys():
-            if not os.path.exists(i):
-                todel.append(i)
-            else:
-                match_val = sum([j.size for j in SM(None, i.lower(), " ".join(args).lower()).get_matching_blocks()])
-                if match_val >= val:
-                    val = match_val
-                    cand = i
-        for i in todel:
-            del STATE[i]
-        with open(STATEFILE, "w") as f:
-            json.dump(STATE, f, indent=4)
         if len(args) == 1 and re.match(r"[0-9]+", args[0]) is not None:
             try:
                 cand = list(STATE.keys())[int(args[0])-1]
                 val = 1
             except IndexError:
                 val = 0
+            if val != 0 and not os.path.exists(cand):
+                delstate([cand])
+                val = 0
+        elif len({"-r"} & set(args)) == 0:
+            # missing files are only found (and forgotten) when ranked first
+            todel = []
+            for score, i in searchhistory(" ".join(args)):
+                if os.path.exists(i):
+                    val, cand = score, i
+                    break
+                todel.append(i)
+            delstate(todel)
         if val != 0 and len({"-r"} & set(args)) == 0:
             file = cand
         else:
@@ -1245,28 +3267,23 @@ def main():
                 sys.exit("ERROR: Found no matching history.")
 
     if dump:
-        epub = Epub(file)
-        epub.initialize()
-        for i in epub.contents:
-            content = epub.file.open(i).read()
-            content = content.decode("utf-8")
-            parser = HTMLtoLines()
-            try:
-                parser.feed(content)
-                parser.close()
-            except:
-                pass
-            src_lines = parser.get_lines()
-            # sys.stdout.reconfigure(encoding="utf-8")  # Python>=3.7
-            for j in src_lines:
-                sys.stdout.buffer.write((j+"\n\n").encode("utf-8"))
+        dump_epub(file, **dumpopts)
         sys.exit()
 
     else:
         if termc < 22 or termr < 12:
             sys.exit("ERR: Screen was too small (min 22cols x 12rows).")
+        init_curses()
+        if TRACE is not None:
+            ttycount()
         curses.wrapper(preread, file)
 
 
 if __name__ == "__main__":
+    # in the frozen Windows binary a spawned worker runs this file again,
+    # freeze_support() hands it over to multiprocessing instead of starting
+    # a reader (a no-op otherwise, so it is only imported when frozen)
+    if getattr(sys, "frozen", False):
+        import multiprocessing
+        multiprocessing.freeze_support()
     main()